@@ -6,7 +6,8 @@ credentials = [
 		'consumer_key': 'CONSUMER_KEY',
 		'consumer_secret': 'CONSUMER_SECRET',
 		'access_token_key': 'ACCESS_TOKEN_KEY',
-		'access_token_secret': 'ACCESS_TOKEN_SECRET'
+		'access_token_secret': 'ACCESS_TOKEN_SECRET',
+		#'proxy': 'socks5h://127.0.0.1:9050'
 	},
 
 	#{
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tweepy
+import tweetlord
+
+
+def cred(n, proxy=None):
+	account = {'consumer_key': 'k{}'.format(n), 'consumer_secret': 's', 'access_token_key': 'a', 'access_token_secret': 't'}
+	if proxy:
+		account['proxy'] = proxy
+	return account
+
+
+def fake_user(i, followers_count=0):
+	return SimpleNamespace(
+		id=i, id_str=str(i), screen_name='user{}'.format(i), name='User {}'.format(i), description='',
+		friends_count=0, followers_count=followers_count, statuses_count=0, favourites_count=0,
+		profile_image_url_https='https://pbs.example/{}_normal.jpg'.format(i), location='', entities={},
+		created_at=tweetlord.datetime.datetime(2015, 1, 1)
+	)
+
+
+def api_error(status_code, api_code=None):
+	return tweepy.error.TweepError('HTTP {}'.format(status_code), SimpleNamespace(status_code=status_code), api_code=api_code)
+
+
+class FakeClient:
+
+	# Stands in for tweepy.API: every account has the full budget. Subclasses add the
+	# API methods a test needs
+
+	remaining = 15
+
+	def rate_limit_status(self):
+		limit = {'limit': 15, 'remaining': self.remaining, 'reset': int(time.time()) + 900}
+		return {'resources': {
+			section: {method: dict(limit)} for section, method in tweetlord.AccountManager.METHODS.items()
+		}}
+
+
+def fake_auth(clients):
+	# Replacement for tweetlord.tweepy_auth: clients maps a consumer key to its FakeClient
+	return lambda cred, mode: clients[cred['consumer_key']]
@@ -0,0 +1,227 @@
+import time
+import unittest
+from unittest import mock
+
+from helpers import FakeClient, api_error, cred, fake_auth, fake_user
+import tweepy
+import tweetlord
+from tweetlord import AccountManager, ApiRequest, CircuitBreaker, CredentialHealth, TweetlordError, classify_error, user_followers
+
+
+class FollowersClient(FakeClient):
+
+	# 450 followers in pages of up to 200; the cursors in errors fail once with the given status
+
+	def __init__(self, total=450, errors=None):
+		self.total = total
+		self.errors = dict(errors or {})
+		self.calls = []
+
+	def followers(self, cursor, count, **kwargs):
+		cursor = max(cursor, 0)
+		self.calls.append(cursor)
+		if cursor in self.errors:
+			raise api_error(self.errors.pop(cursor))
+		ids = range(cursor, min(cursor + count, self.total))
+		next_cursor = cursor + count if cursor + count < self.total else 0
+		return ([fake_user(100 + i) for i in ids], (cursor, next_cursor))
+
+
+class SlowFirstClient(FollowersClient):
+
+	# Whichever account answers first turns out to be slow
+
+	def __init__(self, shared):
+		super().__init__(total=2000)
+		self.shared = shared
+
+	def followers(self, cursor, count, **kwargs):
+		if self.shared.setdefault('slow', self) is self:
+			time.sleep(0.02)
+		return super().followers(cursor, count, **kwargs)
+
+
+class BrokenFirstClient(FollowersClient):
+
+	# Whichever account answers first fails every request with status (and api_code)
+
+	def __init__(self, shared, status, api_code=None):
+		super().__init__()
+		self.shared = shared
+		self.status = status
+		self.api_code = api_code
+
+	def followers(self, cursor, count, **kwargs):
+		if self.shared.setdefault('broken', self) is self:
+			self.calls.append(cursor)
+			raise api_error(self.status, self.api_code)
+		return super().followers(cursor, count, **kwargs)
+
+
+def account_manager(clients):
+	with mock.patch.object(tweetlord, 'tweepy_auth', fake_auth(clients)):
+		return AccountManager([cred(int(key[1:])) for key in clients])
+
+
+class RetryTest(unittest.TestCase):
+
+	def test_backoff_restarts_after_success(self):
+		client = FollowersClient(errors={0: 503, 200: 503, 400: 503})
+		am = account_manager({'k0': client})
+
+		with mock.patch.object(tweetlord, 'backoff_delay', return_value=0) as backoff_delay:
+			rows = list(user_followers(ApiRequest(am, tweetlord._api_followers), 'alice', 450, 450))
+
+		self.assertEqual(len(rows), 450)
+		self.assertEqual(client.calls, [0, 0, 200, 200, 400, 400])
+		# Three isolated errors are three first retries, not an escalating series
+		self.assertEqual([args for args, _ in backoff_delay.call_args_list], [(1,), (1,), (1,)])
+
+
+class ClassifyTest(unittest.TestCase):
+
+	def test_kinds(self):
+		cases = [
+			(api_error(404), 'not_found'),
+			(api_error(429), 'rate_limit'),
+			(api_error(420), 'rate_limit'),
+			(api_error(400, 88), 'rate_limit'),
+			(tweepy.error.RateLimitError('Rate limit'), 'rate_limit'),
+			(tweepy.error.TweepError('Connection reset'), 'transient'),
+			(api_error(500), 'transient'),
+			(api_error(503, 130), 'transient'),
+			(api_error(401, 89), 'revoked'),
+			(api_error(403, 326), 'revoked'),
+			(api_error(401), 'denied'),
+			(api_error(403, 179), 'denied')
+		]
+		for e, kind in cases:
+			with self.subTest(error=str(e), api_code=e.api_code):
+				self.assertEqual(classify_error(e), kind)
+
+
+class HealthTest(unittest.TestCase):
+
+	def test_breaker_opens_after_failures_in_a_row(self):
+		breaker = CircuitBreaker()
+		for _ in range(CircuitBreaker.THRESHOLD - 1):
+			breaker.failure()
+		breaker.success()
+		for _ in range(CircuitBreaker.THRESHOLD - 1):
+			breaker.failure()
+		self.assertTrue(breaker.allows())
+
+		breaker.failure()
+		self.assertFalse(breaker.allows())
+		self.assertGreater(breaker.cooldown(), CircuitBreaker.COOLDOWN - 5)
+
+		# Once the cooldown is over a trial request is let through, and its success closes the breaker
+		opened_at = time.time()
+		with mock.patch.object(tweetlord.time, 'time', return_value=opened_at + CircuitBreaker.COOLDOWN + 1):
+			self.assertTrue(breaker.allows())
+			breaker.failure()
+			self.assertFalse(breaker.allows())
+		breaker.success()
+		self.assertTrue(breaker.allows())
+
+	def test_error_rate_trips_without_a_series(self):
+		health = CredentialHealth()
+		for _ in range(CredentialHealth.MIN_SAMPLES // 2):
+			health.failure('transient', latency=1)
+			health.success(latency=1)
+		self.assertTrue(health.allows())
+
+		health.failure('transient', latency=1)
+		self.assertGreater(health.error_rate(), CredentialHealth.MAX_ERROR_RATE)
+		self.assertFalse(health.allows())
+
+	def test_revoked_mode_left_out(self):
+		health = CredentialHealth()
+		health.failure('revoked', mode='app')
+		self.assertEqual(health.modes(), ['user'])
+		self.assertTrue(health.allows())
+
+		health.failure('revoked', mode='user')
+		self.assertEqual(health.modes(), [])
+		self.assertGreater(health.cooldown(), CredentialHealth.REVOKED_TTL - 5)
+
+		with mock.patch.object(tweetlord.time, 'time', return_value=time.time() + CredentialHealth.REVOKED_TTL + 1):
+			self.assertEqual(health.modes(), ApiRequest.MODES)
+
+	def test_faster_account_ranked_first(self):
+		fast, slow, failing = CredentialHealth(), CredentialHealth(), CredentialHealth()
+		for _ in range(10):
+			fast.success(latency=0.1)
+			slow.success(latency=0.5)
+			failing.success(latency=0.1)
+		failing.failure('transient', latency=0.1)
+		self.assertLess(fast.score(), failing.score())
+		self.assertLess(fast.score(), slow.score())
+
+
+class ErrorFlowTest(unittest.TestCase):
+
+	def dump(self, status, api_code=None, wait_on_rate_limit=False):
+		shared = {}
+		clients = {'k0': BrokenFirstClient(shared, status, api_code), 'k1': BrokenFirstClient(shared, status, api_code)}
+		am = account_manager(clients)
+		self.on_rate_limit = mock.Mock()
+		request = ApiRequest(am, tweetlord._api_followers, wait_on_rate_limit, on_rate_limit=self.on_rate_limit)
+
+		with mock.patch.object(tweetlord, 'backoff_delay', return_value=0):
+			rows = list(user_followers(request, 'alice', 450, 450))
+		broken = shared['broken']
+		return (am, next(account for account in (cred(0), cred(1)) if am.client(account, 'app') is broken), broken, rows)
+
+	def test_transient_retried_then_quarantined(self):
+		am, account, broken, rows = self.dump(503)
+		self.assertEqual(len(rows), 450)
+		self.assertEqual(broken.calls, [-1] * CircuitBreaker.THRESHOLD)
+		self.assertFalse(am.allows(account))
+
+	def test_rate_limit_tries_other_mode_then_account(self):
+		am, account, broken, rows = self.dump(429)
+		self.assertEqual(len(rows), 450)
+		self.assertEqual(broken.calls, [-1, -1])
+		self.on_rate_limit.assert_called_once()
+		self.assertEqual(self.on_rate_limit.call_args[0][0], 0)
+
+	def test_revoked_modes_dropped(self):
+		am, account, broken, rows = self.dump(401, 89)
+		self.assertEqual(len(rows), 450)
+		self.assertEqual(broken.calls, [-1, -1])
+		self.assertEqual(am.modes(account), [])
+
+	def test_denied_gives_up(self):
+		with self.assertRaises(TweetlordError) as cm:
+			self.dump(403)
+		self.assertEqual(cm.exception.errors['kind'], 'denied')
+
+	def test_all_quarantined(self):
+		# Each account is the first of its own shared state, so both are broken
+		clients = {'k0': BrokenFirstClient({}, 503), 'k1': BrokenFirstClient({}, 503)}
+		am = account_manager(clients)
+
+		with mock.patch.object(tweetlord, 'backoff_delay', return_value=0):
+			with self.assertRaises(TweetlordError) as cm:
+				list(user_followers(ApiRequest(am, tweetlord._api_followers), 'alice', 450, 450))
+		self.assertEqual(cm.exception.errors['kind'], 'quarantined')
+		self.assertEqual([len(client.calls) for client in clients.values()], [CircuitBreaker.THRESHOLD] * 2)
+
+
+class AccountChoiceTest(unittest.TestCase):
+
+	def test_switches_to_faster_account_mid_section(self):
+		shared = {}
+		clients = {'k0': SlowFirstClient(shared), 'k1': SlowFirstClient(shared)}
+		am = account_manager(clients)
+
+		rows = list(user_followers(ApiRequest(am, tweetlord._api_followers), 'alice', 2000, 2000))
+		self.assertEqual(len(rows), 2000)
+		# The slow account served the first page only, the rest went to the faster one
+		self.assertEqual(len(shared['slow'].calls), 1)
+		self.assertEqual(sum(len(client.calls) for client in clients.values()), 10)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,65 @@
+import os
+import csv
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import FakeClient, cred, fake_auth, fake_user
+import tweetlord
+from tweetlord import AccountManager, Dumper, crawl
+
+
+FOLLOWERS = 300
+
+
+class GraphClient(FakeClient):
+
+	# The seed (id 1) has FOLLOWERS followers and no friends, nobody else has any
+
+	def __init__(self):
+		self.followers_calls = 0
+
+	def get_user(self, **kwargs):
+		return fake_user(1, FOLLOWERS)
+
+	def followers(self, cursor, count, user_id, **kwargs):
+		self.followers_calls += 1
+		cursor = max(cursor, 0)
+		ids = range(cursor, min(cursor + count, FOLLOWERS)) if user_id == '1' else ()
+		next_cursor = cursor + count if cursor + count < FOLLOWERS and user_id == '1' else 0
+		return ([fake_user(1000 + i) for i in ids], (cursor, next_cursor))
+
+
+class CrawlTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.tmp.name, 'graph')
+		self.client = GraphClient()
+		with mock.patch.object(tweetlord, 'tweepy_auth', fake_auth({'k0': self.client})):
+			self.dumper = Dumper([cred(0)])
+
+	def tearDown(self):
+		self.dumper.close()
+		self.tmp.cleanup()
+
+	def crawl(self, max_nodes):
+		crawl(self.dumper, 'snovvcrash', 1, max_nodes, 0, -1, self.filename)
+		with open(self.filename + '.edges.csv', encoding='utf-8') as f:
+			edges = list(csv.reader(f))[1:]
+		with sqlite3.connect(self.filename + '.crawl.db') as conn:
+			nodes, expanded = conn.execute('SELECT COUNT(*), SUM(expanded) FROM nodes').fetchone()
+		return (nodes, expanded, len(edges))
+
+	def test_max_nodes_keeps_node_in_frontier(self):
+		# The cap is hit on the first page: the rest of the seed's followers aren't even fetched
+		self.assertEqual(self.crawl(100), (100, 0, 99))
+		self.assertEqual(self.client.followers_calls, 1)
+
+		# A bigger cap finds the followers that didn't fit
+		self.assertEqual(self.crawl(1000), (FOLLOWERS + 1, 1, FOLLOWERS))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,202 @@
+import json
+import time
+import socket
+import struct
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from helpers import FakeClient, cred, fake_auth
+import tweetlord
+from tweetlord import AccountManager, ProxiedAppAuthHandler, TweetlordError, tweepy_auth
+
+
+TOKEN_URL = 'http://api.twitter.test/oauth2/token'
+
+
+class TokenHandler(BaseHTTPRequestHandler):
+
+	# Plays both the HTTP proxy (it gets the absolute URI) and the API behind the SOCKS proxy
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		self.server.seen.append(self.path)
+		if self.server.token is None:
+			body = b'<html><body>502 Bad Gateway</body></html>'
+			self.send_response(502)
+		else:
+			body = json.dumps({'token_type': 'bearer', 'access_token': self.server.token}).encode('utf-8')
+			self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class Socks5Server:
+
+	# No-auth SOCKS5 CONNECT that records the requested address and pipes everything to upstream
+
+	def __init__(self, upstream):
+		self.upstream = upstream
+		self.seen = []
+		self._sock = socket.socket()
+		self._sock.bind(('127.0.0.1', 0))
+		self._sock.listen(8)
+		self.port = self._sock.getsockname()[1]
+		threading.Thread(target=self._accept, daemon=True).start()
+
+	def close(self):
+		self._sock.close()
+
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self._sock.accept()
+			except OSError:
+				return
+			threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+	def _handle(self, conn):
+		conn.recv(262)
+		conn.sendall(b'\x05\x00')
+		request = conn.recv(4)
+		if request[3] == 3:
+			host = conn.recv(conn.recv(1)[0]).decode('ascii')
+		else:
+			host = socket.inet_ntoa(conn.recv(4))
+		port, = struct.unpack('>H', conn.recv(2))
+		self.seen.append((host, port))
+
+		upstream = socket.create_connection(self.upstream)
+		conn.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 0))
+		threading.Thread(target=self._pipe, args=(upstream, conn), daemon=True).start()
+		self._pipe(conn, upstream)
+
+	@staticmethod
+	def _pipe(src, dst):
+		try:
+			while True:
+				data = src.recv(65536)
+				if not data:
+					break
+				dst.sendall(data)
+		except OSError:
+			pass
+		finally:
+			try:
+				dst.shutdown(socket.SHUT_WR)
+			except OSError:
+				pass
+
+
+def serve(token):
+	server = ThreadingHTTPServer(('127.0.0.1', 0), TokenHandler)
+	server.seen = []
+	server.token = token
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+class ProxyTest(unittest.TestCase):
+
+	def setUp(self):
+		self.http_proxy = serve('via-http')
+		self.api = serve('via-socks')
+		self.socks_proxy = Socks5Server(self.api.server_address)
+		patcher = mock.patch.object(ProxiedAppAuthHandler, '_get_oauth_url', lambda self, endpoint: TOKEN_URL)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		for server in (self.http_proxy, self.api):
+			server.shutdown()
+			server.server_close()
+		self.socks_proxy.close()
+
+	def test_token_through_http_proxy(self):
+		client = tweepy_auth(cred(0, 'http://user:pw@127.0.0.1:{}'.format(self.http_proxy.server_address[1])), 'app')
+		self.assertEqual(client.auth._bearer_token, 'via-http')
+		self.assertEqual(self.http_proxy.seen, [TOKEN_URL])
+		self.assertEqual((self.api.seen, self.socks_proxy.seen), ([], []))
+
+	def test_token_through_socks_proxy(self):
+		client = tweepy_auth(cred(1, 'socks5h://127.0.0.1:{}'.format(self.socks_proxy.port)), 'app')
+		self.assertEqual(client.auth._bearer_token, 'via-socks')
+		self.assertEqual(self.socks_proxy.seen, [('api.twitter.test', 80)])
+		self.assertEqual(self.api.seen, ['/oauth2/token'])
+		self.assertEqual(self.http_proxy.seen, [])
+
+	def test_proxy_error_page(self):
+		self.http_proxy.token = None
+		account = cred(2, 'http://127.0.0.1:{}'.format(self.http_proxy.server_address[1]))
+		with self.assertRaises(TweetlordError) as raised:
+			tweepy_auth(account, 'app')
+		self.assertEqual(
+			str(raised.exception),
+			'Could not get the app-auth token of account {} through http://127.0.0.1:{}'.format(
+				tweetlord.cred_id(account), self.http_proxy.server_address[1]
+			)
+		)
+
+	def test_proxy_down(self):
+		# Nothing listens on a port that was just closed
+		sock = socket.socket()
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+
+		for proxy in ('http://127.0.0.1:{}'.format(port), 'socks5h://127.0.0.1:{}'.format(port)):
+			with self.subTest(proxy=proxy), self.assertRaises(TweetlordError) as raised:
+				AccountManager([cred(3, proxy)])
+			self.assertIn(tweetlord.egress_name(proxy), str(raised.exception))
+
+
+class EgressTest(unittest.TestCase):
+
+	def test_invalid_proxy(self):
+		for proxy in ('127.0.0.1:8080', 'localhost:3128', 'ftp://127.0.0.1:21', 'http://', 'http://127.0.0.1:port'):
+			with self.subTest(proxy=proxy), self.assertRaises(TweetlordError):
+				AccountManager([cred(0, proxy)])
+
+	def test_limit_shared_under_concurrency(self):
+		proxy = 'socks5h://user:pw@127.0.0.1:1080'
+		creds = [cred(0, proxy), cred(1, proxy), cred(2)]
+		with mock.patch.object(tweetlord, 'tweepy_auth', fake_auth({'k0': FakeClient(), 'k1': FakeClient(), 'k2': FakeClient()})):
+			am = AccountManager(creds, egress_limit=2)
+
+		egress = am.egress(creds[0])
+		self.assertIs(am.egress(creds[1]), egress)
+		self.assertIsNot(am.egress(creds[2]), egress)
+		self.assertEqual(sorted(stats['egress'] for stats in am.egress_stats()), ['direct', 'socks5h://127.0.0.1:1080'])
+
+		lock = threading.Lock()
+		in_flight = [0]
+		peak = [0]
+
+		def request(account):
+			with am.egress(account).request():
+				with lock:
+					in_flight[0] += 1
+					peak[0] = max(peak[0], in_flight[0])
+				time.sleep(0.02)
+				with lock:
+					in_flight[0] -= 1
+
+		threads = [threading.Thread(target=request, args=(creds[i % 2],)) for i in range(12)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(peak[0], 2)
+		# Both limit probes of the two proxied accounts went out through it too
+		stats = {stats['egress']: stats for stats in am.egress_stats()}
+		self.assertEqual(stats['socks5h://127.0.0.1:1080']['requests'], 12 + 4)
+
+
+if __name__ == '__main__':
+	unittest.main()
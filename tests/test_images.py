@@ -0,0 +1,93 @@
+import os
+import csv
+import time
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import helpers  # puts the repo root on sys.path
+from tweetlord import ImageDownloader, FollowerRow
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+
+	# /<n>.jpg serves one of three images, /missing/... is a 404
+
+	def do_GET(self):
+		time.sleep(0.002)
+		if self.path.startswith('/missing/'):
+			self.send_error(404)
+			return
+		body = 'image {}'.format(int(self.path[1:].split('.')[0]) % 3).encode('ascii')
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class ImageDownloaderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.base = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.tmp.cleanup()
+
+	def row(self, path):
+		return FollowerRow('', self.base + path, '1', 'user1', 'User 1', '')
+
+	def test_bounded_and_indexed(self):
+		filename = os.path.join(self.tmp.name, 'out')
+		downloader = ImageDownloader(os.path.join(self.tmp.name, 'images'), filename, workers=2)
+
+		# Count the downloads that were submitted but not done yet
+		lock = threading.Lock()
+		pending = [0]
+		peak = [0]
+		fetch, submit = downloader._fetch, downloader._executor.submit
+
+		def counted_submit(*args):
+			with lock:
+				pending[0] += 1
+				peak[0] = max(peak[0], pending[0])
+			return submit(*args)
+
+		def counted_fetch(url):
+			try:
+				return fetch(url)
+			finally:
+				with lock:
+					pending[0] -= 1
+
+		with mock.patch.object(downloader, '_fetch', counted_fetch), \
+				mock.patch.object(downloader._executor, 'submit', counted_submit):
+			for i in range(200):
+				downloader.submit('followers', self.row('/{}.jpg'.format(i % 150)))
+			downloader.submit('followers', self.row('/missing/1.jpg'))
+			downloader.submit('timeline', self.row('/999.jpg'))  # not a profile section
+			stats = downloader.close()
+
+		self.assertLessEqual(peak[0], 2 * ImageDownloader.BACKLOG)
+		# Two workers may race on the same new image, so only the total is exact
+		self.assertEqual((stats['downloaded'] + stats['duplicate'], stats['failed']), (150, 1))
+
+		with open(filename + '.images.csv', encoding='utf-8') as f:
+			rows = list(csv.reader(f))
+		self.assertEqual(rows[0], ['Profile Image URL', 'SHA-256', 'Path', 'Status'])
+		self.assertEqual(len(rows) - 1, 151)
+		self.assertEqual(len({row[0] for row in rows[1:]}), 151)
+		self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(self.tmp.name, 'images'))), 3)
+
+
+if __name__ == '__main__':
+	unittest.main()
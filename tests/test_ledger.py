@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import unittest
+from unittest import mock
+
+import helpers  # puts the repo root on sys.path
+from tweetlord import LeaseLedger, TweetlordError
+
+
+class LeaseLedgerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, 'ledger.db')
+		self.ledgers = []
+		self.ledger = self.open('other:1')
+
+		reset = int(time.time()) + 600
+		self.ledger.record('empty', 'followers', 15, 0, reset)
+		self.ledger.record('low', 'followers', 15, 5, reset)
+		self.ledger.record('high', 'followers', 15, 10, reset)
+
+	def tearDown(self):
+		for ledger in self.ledgers:
+			ledger.close()
+		self.tmp.cleanup()
+
+	def open(self, owner):
+		ledger = LeaseLedger(self.path, owner=owner)
+		self.ledgers.append(ledger)
+		return ledger
+
+	def acquire(self, ledger, scores=None):
+		return ledger.acquire('followers', scores or {'empty': 0, 'low': 0, 'high': 0})
+
+	def leases(self):
+		return self.ledger._conn.execute('SELECT cred, owner FROM leases ORDER BY cred, owner').fetchall()
+
+	def test_acquire_order(self):
+		# Most budget left wins among equals, a better score beats budget, an empty account comes last
+		self.assertEqual(self.acquire(self.ledger)[:2], ('high', 10))
+		self.assertEqual(self.acquire(self.ledger, {'empty': 0, 'low': 0, 'high': 1})[0], 'low')
+		self.assertEqual(self.acquire(self.ledger, {'empty': 0})[:2], ('empty', 0))
+
+		# A process leases one account per section: acquiring again gives the previous lease up
+		self.assertEqual(self.leases(), [('empty', 'other:1:{}'.format(threading.get_ident()))])
+
+	def test_fewer_leases_first(self):
+		other = self.open('other:2')
+		self.assertEqual(self.acquire(other)[0], 'high')
+		self.assertEqual(self.acquire(self.ledger)[0], 'low')
+
+		# Leases are per thread as well: this one doesn't replace the lease on low, so both
+		# accounts with budget have one and an empty account is still only the last resort
+		result = []
+		thread = threading.Thread(target=lambda: result.append(self.acquire(self.ledger)[0]))
+		thread.start()
+		thread.join()
+		self.assertEqual(result, ['high'])
+		self.assertEqual(len(self.leases()), 3)
+
+	def test_unknown_credentials(self):
+		with self.assertRaises(TweetlordError) as cm:
+			self.ledger.acquire('search', {'high': 0})
+		self.assertEqual(cm.exception.errors['code'], 3)
+
+	def test_exhaust(self):
+		self.assertEqual(self.acquire(self.ledger)[0], 'high')
+		self.ledger.exhaust('high', 'followers')
+		self.assertEqual(self.leases(), [])
+
+		cred, remaining, reset = self.acquire(self.ledger, {'high': 0})
+		self.assertEqual((cred, remaining), ('high', 0))
+		self.assertGreaterEqual(reset, int(time.time()) + LeaseLedger.WINDOW - 5)
+		self.assertEqual(self.acquire(self.ledger)[0], 'low')
+
+	def test_consume_and_refill(self):
+		self.ledger.consume('low', 'followers', 3)
+		self.assertEqual(self.acquire(self.ledger, {'low': 0})[1], 2)
+		self.ledger.consume('low', 'followers', 5)
+		self.assertEqual(self.acquire(self.ledger, {'low': 0})[1], 0)
+
+		# Past the reset the account has its full limit again, and the next call starts a new window
+		self.ledger.record('low', 'followers', 15, 0, int(time.time()) - 1)
+		self.assertEqual(self.acquire(self.ledger, {'low': 0})[1], 15)
+		self.ledger.consume('low', 'followers')
+		cred, remaining, reset = self.acquire(self.ledger, {'low': 0})
+		self.assertEqual(remaining, 14)
+		self.assertGreaterEqual(reset, int(time.time()) + LeaseLedger.WINDOW - 5)
+
+	def test_expired_lease_cleared(self):
+		other = self.open('other:2')
+		with mock.patch.object(LeaseLedger, 'LEASE_TTL', 0):
+			self.assertEqual(self.acquire(other)[0], 'high')
+		self.assertEqual(self.acquire(self.ledger)[0], 'high')
+
+	def test_dead_process_lease_cleared(self):
+		dead = subprocess.Popen([sys.executable, '-c', ''])
+		dead.wait()
+		hostname = socket.gethostname()
+
+		self.assertEqual(self.acquire(self.open('{}:{}'.format(hostname, os.getpid())))[0], 'high')
+		self.assertEqual(self.acquire(self.open('{}:{}'.format(hostname, dead.pid)))[0], 'low')
+
+		# The live process keeps its lease, the dead one's is gone
+		self.assertEqual(self.acquire(self.ledger)[0], 'low')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from helpers import FakeClient, cred, fake_auth
+import tweetlord
+from tweetlord import AccountManager, ApiRequest
+
+
+TWEETS = 450
+
+
+class StatusesClient(FakeClient):
+
+	# TWEETS statuses with ids 1..TWEETS, newest first. max_id is inclusive like the real API;
+	# the max_ids in overlap also get the status just above them, as if the timeline had shifted
+
+	def __init__(self, overlap=()):
+		self.overlap = set(overlap)
+		self.calls = []
+
+	def user_timeline(self, count, max_id=None, **kwargs):
+		self.calls.append((max_id, count, kwargs.get('screen_name'), kwargs.get('user_id')))
+		top = TWEETS if max_id is None else max_id
+		page = [SimpleNamespace(id=i) for i in range(top, 0, -1)][:count]
+		if max_id in self.overlap and max_id < TWEETS:
+			page = [SimpleNamespace(id=max_id + 1)] + page[:count - 1]
+		return page
+
+	favorites = user_timeline
+
+
+class PagesTest(unittest.TestCase):
+
+	METHODS = (tweetlord._api_timeline, tweetlord._api_favorites)
+
+	def pages(self, api_method, username, count, max_items, overlap=()):
+		client = StatusesClient(overlap)
+		with mock.patch.object(tweetlord, 'tweepy_auth', fake_auth({'k0': client})):
+			am = AccountManager([cred(0)])
+		pages = list(tweetlord._api_pages(ApiRequest(am, api_method), username, count, max_items))
+		return (client.calls, [[status.id for status in page] for page in pages])
+
+	def test_max_id_progression(self):
+		for api_method in PagesTest.METHODS:
+			with self.subTest(api_method=api_method.__name__):
+				calls, pages = self.pages(api_method, 'alice', 10 ** 6, 10 ** 6)
+				# Each page starts below the lowest id seen, the empty page ends it
+				self.assertEqual(calls, [
+					(None, 200, 'alice', None), (250, 200, 'alice', None), (50, 200, 'alice', None), (0, 200, 'alice', None)
+				])
+				self.assertEqual(sum(pages, []), list(range(TWEETS, 0, -1)))
+
+	def test_user_id(self):
+		calls, _ = self.pages(tweetlord._api_timeline, 'id42', 10, 10)
+		self.assertEqual(calls, [(None, 200, None, '42')])
+
+	def test_overlap_deduplicated(self):
+		for api_method in PagesTest.METHODS:
+			with self.subTest(api_method=api_method.__name__):
+				calls, pages = self.pages(api_method, 'alice', TWEETS, TWEETS, overlap=(250,))
+				ids = sum(pages, [])
+				self.assertEqual(sorted(ids, reverse=True), list(range(TWEETS, 0, -1)))
+				self.assertEqual([max_id for max_id, _, _, _ in calls], [None, 250, 51])
+				self.assertEqual([len(page) for page in pages], [200, 199, 51])
+
+	def test_count_cut_from_last_page(self):
+		for api_method in PagesTest.METHODS:
+			with self.subTest(api_method=api_method.__name__):
+				calls, pages = self.pages(api_method, 'alice', 250, TWEETS)
+				# A full page is still requested, only 50 of it are kept
+				self.assertEqual([(max_id, count) for max_id, count, _, _ in calls], [(None, 200), (250, 200)])
+				self.assertEqual(sum(pages, []), list(range(TWEETS, TWEETS - 250, -1)))
+
+	def test_stops_at_max_items(self):
+		# The account reports 300 statuses: no call is spent on the rest of the timeline
+		calls, _ = self.pages(tweetlord._api_timeline, 'alice', 10 ** 6, 300)
+		self.assertEqual([max_id for max_id, _, _, _ in calls], [None, 250])
+
+
+if __name__ == '__main__':
+	unittest.main()
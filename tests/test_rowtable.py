@@ -0,0 +1,42 @@
+import unittest
+
+import helpers  # puts the repo root on sys.path
+from tweetlord import RowTable, TimelineRow, FavoriteRow, build_summary
+
+
+TIMELINE = [
+	TimelineRow('2018-01-01 10:00:00', 'first', 'https://twitter.com/alice/status/1', 3, 1, 2, 48.5),
+	TimelineRow('2018-01-02 11:30:00', 'second', 'https://twitter.com/alice/status/2', None, 0, '', ''),
+	TimelineRow('2018-01-03 12:00:00', 'third', 'https://twitter.com/alice/status/3', 0, None, -33.25, 151),
+]
+
+
+class RowTableTest(unittest.TestCase):
+
+	def test_round_trip(self):
+		table = RowTable(TimelineRow)
+		table.extend(TIMELINE)
+
+		self.assertEqual(list(table), TIMELINE)
+		self.assertEqual([table[i] for i in range(-len(TIMELINE), len(TIMELINE))], TIMELINE * 2)
+		# Not only equal: int coordinates stay ints, missing counts stay None
+		self.assertEqual([tuple(map(type, row)) for row in table], [tuple(map(type, row)) for row in TIMELINE])
+
+	def test_summary_skips_missing_counts(self):
+		favorites = RowTable(FavoriteRow)
+		favorites.extend([
+			FavoriteRow('a', 'https://twitter.com/bob/status/7', 'bob', 'Bob', None, None, '', ''),
+			FavoriteRow('b', 'https://twitter.com/bob/status/8', 'bob', 'Bob', None, 5, '', '')
+		])
+		timeline = RowTable(TimelineRow)
+		timeline.extend(TIMELINE)
+
+		summary = build_summary({'timeline': timeline, 'favorites': favorites})
+		self.assertEqual((summary['timeline']['favorite_count']['min'], summary['timeline']['favorite_count']['max']), (0, 3))
+		self.assertEqual(sum(n for _, n in summary['timeline']['favorite_count']['buckets']), 2)
+		self.assertIsNone(summary['favorites']['favorite_count']['median'])
+		self.assertEqual(summary['favorites']['retweet_count']['mean'], 5)
+
+
+if __name__ == '__main__':
+	unittest.main()
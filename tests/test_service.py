@@ -0,0 +1,37 @@
+import unittest
+
+import helpers  # puts the repo root on sys.path
+from tweetlord import JobServer
+
+
+class JobServerTest(unittest.TestCase):
+
+	def setUp(self):
+		# Jobs are only queued, no worker threads are started
+		self.server = JobServer(None, '/srv/dumps', workers=1)
+
+	def test_all_with_counts_rejected(self):
+		with self.assertRaisesRegex(ValueError, 'Incompatible parameters: all,followers,timeline'):
+			self.server.submit({'user': 'alice', 'all': True, 'followers': 100, 'timeline': 5}, 'a')
+
+		job = self.server.submit({'user': 'alice', 'all': True}, 'a')
+		self.assertEqual(job['counts'], {'friends': -1, 'followers': -1, 'favorites': -1, 'timeline': -1, 'search': 0})
+
+	def test_output_taken(self):
+		first = self.server.submit({'user': 'alice', 'output': 'alice'}, 'a')
+		self.assertEqual(first['result'], '/srv/dumps/alice.xlsx')
+		with self.assertRaisesRegex(ValueError, 'already used by job {}'.format(first['id'])):
+			self.server.submit({'user': 'bob', 'output': 'alice'}, 'b')
+
+		# Another format is another file, and a failed job gives its name up
+		self.server.submit({'user': 'bob', 'output': 'alice', 'format': 'jsonl'}, 'b')
+		first['status'] = 'failed'
+		self.assertEqual(self.server.submit({'user': 'bob', 'output': 'alice'}, 'b')['result'], '/srv/dumps/alice.xlsx')
+
+	def test_default_outputs_unique(self):
+		results = {self.server.submit({'user': 'alice'}, 'a')['result'] for _ in range(3)}
+		self.assertEqual(len(results), 3)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import helpers  # puts the repo root on sys.path
+from tweetlord import SqliteSink, UserRow, TimelineRow
+
+
+class SqliteSinkTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, 'dumps.db')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_coordinates(self):
+		sink = SqliteSink(self.path, 'alice')
+		sink.write('user', UserRow(
+			'https://twitter.com/alice', 'https://pbs.twimg.com/profile_images/1.jpg', '1', 'alice', 'Alice', '',
+			0, 0, 3, 0, '', '', '2015-01-01 00:00:00'
+		))
+		for tweet_id, latitude, longitude in ((10, 0.0, 0), (11, '', ''), (12, -33.25, 151)):
+			sink.write('timeline', TimelineRow(
+				'2018-01-01 10:00:00', 'tweet', 'https://twitter.com/alice/status/{}'.format(tweet_id), 0, 0, latitude, longitude
+			))
+		sink.close()
+
+		with sqlite3.connect(self.path) as conn:
+			rows = conn.execute('SELECT id, latitude, longitude FROM tweets ORDER BY id').fetchall()
+		self.assertEqual(rows, [(10, 0.0, 0.0), (11, None, None), (12, -33.25, 151.0)])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from helpers import FakeClient, api_error, cred, fake_auth, fake_user
+import tweetlord
+from tweetlord import WorkStore, AccountManager, UserRow, submit_job, work
+
+
+FOLLOWERS = 450
+
+
+class WorkerClient(FakeClient):
+
+	# fail_user / fail_page make get_user or the followers page at that cursor fail with a 403
+
+	def __init__(self, fail_user=False, fail_page=None):
+		self.fail_user = fail_user
+		self.fail_page = fail_page
+
+	def get_user(self, **kwargs):
+		if self.fail_user:
+			raise api_error(403)
+		return fake_user(1, FOLLOWERS)
+
+	def followers(self, cursor, count, **kwargs):
+		cursor = max(cursor, 0)
+		if cursor == self.fail_page:
+			raise api_error(403)
+		ids = range(cursor, min(cursor + count, FOLLOWERS))
+		next_cursor = cursor + count if cursor + count < FOLLOWERS else 0
+		return ([fake_user(100 + i) for i in ids], (cursor, next_cursor))
+
+
+class WorkStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.store = WorkStore(os.path.join(self.tmp.name, 'store.db'))
+		self.job_id = submit_job(self.store, 'snovvcrash', {'followers': -1}, fmt='jsonl', output='out')
+
+	def tearDown(self):
+		self.store.close()
+		self.tmp.cleanup()
+
+	def test_expired_heartbeat_takeover(self):
+		unit = self.store.claim('a')
+		self.assertIsNotNone(unit)
+		self.assertIsNone(self.store.claim('b'))
+
+		with mock.patch.object(WorkStore, 'UNIT_TTL', 0):
+			time.sleep(0.01)
+			taken = self.store.claim('b')
+		self.assertEqual(taken['id'], unit['id'])
+
+	def test_stale_complete_rejected(self):
+		unit = self.store.claim('a')
+		with mock.patch.object(WorkStore, 'UNIT_TTL', 0):
+			time.sleep(0.01)
+			taken = self.store.claim('b')
+
+		# The stale worker can neither keep the unit alive nor store its rows
+		self.store.heartbeat(unit, 'a')
+		self.assertFalse(self.store.complete(unit, 'a', [['stale']], [('followers', 'x', 0, -1, 0, 1, 1)]))
+		self.assertEqual(list(self.store.table_rows(self.job_id, 'user')), [])
+
+		self.assertTrue(self.store.complete(taken, 'b', [['fresh']], []))
+		self.assertEqual(list(self.store.table_rows(self.job_id, 'user')), [['fresh']])
+		self.assertIsNone(self.store.claim('c'))
+
+	def test_failed_unit(self):
+		user_unit = self.store.claim('a')
+		self.assertFalse(self.store.complete(user_unit, 'a', [['user']], [('followers', 'snovvcrash', 0, -1, 0, 450, 450)]))
+
+		unit = self.store.claim('a')
+		for attempt in range(WorkStore.MAX_ATTEMPTS - 1):
+			self.assertFalse(self.store.release(unit, 'a', failed=True))
+			unit = self.store.claim('a')
+			self.assertEqual(unit['attempts'], attempt + 1)
+
+		# The last attempt gives up on the unit and hands the job over for assembly
+		self.assertTrue(self.store.release(unit, 'a', failed=True))
+		self.assertIsNone(self.store.claim('a'))
+		self.assertEqual(self.store.jobs()[0][1], 'assembling')
+
+		self.assertEqual(self.store.finish_job(self.job_id), ['followers'])
+		self.assertEqual(self.store.jobs()[0], (self.job_id, 'incomplete', 'Incomplete sections: followers', 2, 1))
+
+	def test_output_path(self):
+		job_id = submit_job(self.store, 'snovvcrash', {}, output='/mnt/share/snov?vcrash dump')
+		self.assertEqual(self.store.spec(job_id)['output'], '/mnt/share/snovvcrash_dump')
+
+
+class WorkTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.store = WorkStore(os.path.join(self.tmp.name, 'store.db'))
+		self.output = os.path.join(self.tmp.name, 'out')
+		self.job_id = submit_job(self.store, 'snovvcrash', {'followers': -1}, fmt='jsonl', output=self.output)
+
+	def tearDown(self):
+		self.store.close()
+		self.tmp.cleanup()
+
+	def run_worker(self, client):
+		stop = threading.Event()
+		with mock.patch.object(tweetlord, 'tweepy_auth', fake_auth({'k0': client})), \
+				mock.patch.object(tweetlord, 'BACKOFF_BASE', 0.001):
+			am = AccountManager([cred(0)])
+			worker = threading.Thread(target=work, args=(am, self.store), kwargs={'poll': 0.01, 'stop': stop})
+			worker.start()
+			try:
+				deadline = time.time() + 30
+				while any(job[1] in ('running', 'assembling') for job in self.store.jobs()) and time.time() < deadline:
+					time.sleep(0.01)
+			finally:
+				stop.set()
+				worker.join()
+				am.close()
+
+		return self.store.jobs()
+
+	def records(self, section):
+		with open(self.output + '.jsonl', encoding='utf-8') as f:
+			return [record for record in map(json.loads, f) if record['section'] == section]
+
+	def test_job_done(self):
+		(job_id, status, error, units, done), = self.run_worker(WorkerClient())
+		self.assertEqual((status, error), ('done', None))
+		self.assertEqual(units, done)
+		self.assertEqual(len(self.records('followers')), FOLLOWERS)
+
+	def test_failed_page_marks_job_incomplete(self):
+		(job_id, status, error, units, done), = self.run_worker(WorkerClient(fail_page=200))
+		self.assertEqual((status, error), ('incomplete', 'Incomplete sections: followers'))
+		self.assertEqual(done, units - 1)
+		self.assertEqual(len(self.records('followers')), 200)
+
+	def test_failed_user_unit_fails_job(self):
+		(job_id, status, error, units, done), = self.run_worker(WorkerClient(fail_user=True))
+		self.assertEqual((status, error), ('failed', 'Basic account info could not be collected'))
+		self.assertFalse(os.path.exists(self.output + '.jsonl'))
+
+	def test_unwritable_output_fails_job(self):
+		job_id = submit_job(self.store, 'snovvcrash', {'followers': 10}, fmt='xlsx', output='/nonexistent/dir/out')
+		jobs = self.run_worker(WorkerClient())
+
+		# The worker survives and finishes the other job
+		self.assertEqual(jobs[0][1], 'done')
+		self.assertEqual(jobs[1][:2], (job_id, 'failed'))
+		self.assertTrue(jobs[1][2].startswith('Could not write the output: '))
+
+	def test_stuck_assembly_taken_over(self):
+		unit = self.store.claim('dead')
+		user_row = UserRow('https://twitter.com/user1', '', '1', 'user1', 'User 1', '', 0, 0, 0, 0, '', '', '2015-01-01 00:00:00')
+		self.assertTrue(self.store.complete(unit, 'dead', [list(user_row)], []))
+		self.assertEqual(self.store.jobs()[0][1], 'assembling')
+
+		with mock.patch.object(WorkStore, 'UNIT_TTL', 0.3):
+			time.sleep(0.35)
+			(job_id, status, error, units, done), = self.run_worker(WorkerClient())
+		self.assertEqual((status, error), ('done', None))
+		self.assertEqual(len(self.records('user')), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -29,21 +29,38 @@ __version__ = '0.1'
 __site__    = 'https://github.com/snovvcrash/tweetlord'
 __brief__   = 'Twitter profile dumper.'
 
+import os
+import csv
 import json
+import socket
 import string
 import sys
 import time
+import random
+import hashlib
+import sqlite3
 import datetime
+import operator
+import itertools
+import threading
 from queue import PriorityQueue
+from heapq import heapify
+from bisect import bisect_left
+from array import array
+from collections import deque, namedtuple, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from html import unescape
+from urllib.parse import urlsplit
 from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import tweepy
+import requests
 import xlsxwriter
 from tqdm import tqdm
 from termcolor import cprint, colored
 
-from credentials import credentials
 
 
 # ----------------------------------------------------------
@@ -121,12 +138,51 @@ TIMELINE_COLS = [
 	'Longitude'
 ]
 
+SEARCH_COLS = [
+	'Created at',
+	'Tweet Text',
+	'Tweet URL',
+	'User ID',
+	'User Login',
+	'User Name',
+	'Favorite Count',
+	'Retweet Count',
+	'Latitude',
+	'Longitude'
+]
+
+def _row_type(name, cols):
+	return namedtuple(name, [col.lower().replace(' ', '_') for col in cols])
+
+
+UserRow = _row_type('UserRow', USER_COLS)
+FriendRow = _row_type('FriendRow', FRIENDS_COLS)
+FollowerRow = _row_type('FollowerRow', FOLLOWERS_COLS)
+FavoriteRow = _row_type('FavoriteRow', FAVORITES_COLS)
+TimelineRow = _row_type('TimelineRow', TIMELINE_COLS)
+SearchRow = _row_type('SearchRow', SEARCH_COLS)
+
+ROW_TYPES = {
+	'user': UserRow,
+	'friends': FriendRow,
+	'followers': FollowerRow,
+	'favorites': FavoriteRow,
+	'timeline': TimelineRow,
+	'search': SearchRow
+}
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Lower bounds of the favorite/retweet count buckets in the summary
+COUNT_BUCKETS = [0, 1, 2, 6, 11, 51, 101, 1001]
+
 PROC_NAMES = {
 	'_api_user': 'api.get_user',
 	'_api_friends': 'api.friends',
 	'_api_followers': 'api.followers',
 	'_api_favorites': 'api.favorites',
-	'_api_timeline': 'api.user_timeline'
+	'_api_timeline': 'api.user_timeline',
+	'_api_search': 'api.search'
 }
 
 SECTION_NAMES = {
@@ -134,17 +190,32 @@ SECTION_NAMES = {
 	'api.friends': 'friends',
 	'api.followers': 'followers',
 	'api.favorites': 'favorites',
-	'api.user_timeline': 'statuses'
+	'api.user_timeline': 'statuses',
+	'api.search': 'search'
 }
 
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# Requests in flight per egress (a proxy or the direct connection)
+EGRESS_LIMIT = 4
+
+# socks4:// and socks5:// need PySocks
+PROXY_SCHEMES = ('http', 'https', 'socks4', 'socks4a', 'socks5', 'socks5h')
+
+# Could not authenticate, invalid or expired token, bad authentication data, account locked
+REVOKED_API_CODES = (32, 89, 99, 215, 326)
+
+DEBUG = False
+
 
 # ----------------------------------------------------------
 # -------------------------- Core --------------------------
 # ----------------------------------------------------------
 
 
-def user_info(am, username):
-	user = _api_handler(am, _api_user, username)
+def user_info(request, username):
+	user = request.call(username)
 
 	id_str = user.id_str
 	screen_name = user.screen_name
@@ -165,7 +236,7 @@ def user_info(am, username):
 
 	created_at = user.created_at.strftime('%Y-%m-%d %H:%M:%S')
 
-	return ([
+	return (UserRow(
 		profile_url,
 		profile_image_url,
 		id_str,
@@ -179,7 +250,7 @@ def user_info(am, username):
 		location,
 		website,
 		created_at
-	], {
+	), {
 		'friends': friends_count,
 		'followers': followers_count,
 		'favorites': favorites_count,
@@ -187,126 +258,363 @@ def user_info(am, username):
 	})
 
 
-def user_friends(am, username, count, max_friends):
-	friends = _api_handler(am, _api_friends, username, count, max_friends, 'fr')
-
-	table_rows = []
-	for friend in friends:
-		id_str = friend.id_str
-		screen_name = friend.screen_name
-		name = friend.name
-		profile_url = 'https://twitter.com/' + screen_name
-		profile_image_url = friend.profile_image_url_https.replace('_normal', '_400x400')
-		description = unescape(friend.description)
-
-		table_rows.append([
-			profile_url,
-			profile_image_url,
-			id_str,
-			screen_name,
-			name,
-			description
-		])
-
-	return table_rows
-
-
-def user_followers(am, username, count, max_followers):
-	followers = _api_handler(am, _api_followers, username, count, max_followers, 'fol')
-
-	table_rows = []
-	for follower in followers:
-		id_str = follower.id_str
-		screen_name = follower.screen_name
-		name = follower.name
-		profile_url = 'https://twitter.com/' + screen_name
-		profile_image_url = follower.profile_image_url_https.replace('_normal', '_400x400')
-		description = unescape(follower.description)
-
-		table_rows.append([
-			profile_url,
-			profile_image_url,
-			id_str,
-			screen_name,
-			name,
-			description
-		])
-
-	return table_rows
-
-
-def user_favorites(am, username, count, max_favorites, tweet_extended):
-	statuses = _api_handler(am, _api_favorites, username, count, max_favorites, 'fav', tweet_extended)
-
-	table_rows = []
-	for status in statuses:
-		if tweet_extended:
-			text = unescape(status.full_text)
-		else:
-			text = unescape(status.text)
+def user_friends(request, username, count, max_friends):
+	for friends in _api_pages(request, username, count, max_friends):
+		for friend in friends:
+			yield _friend_row(friend)
 
-		screen_name = status.author.screen_name
-		name = status.author.name
-		status_url = 'https://twitter.com/' + screen_name + '/status/' + status.id_str
-		favorite_count = status.favorite_count
-		retweet_count = status.retweet_count
 
-		geo = status.geo
-		if geo:
-			latitude, longitude = geo['coordinates']
-		else:
-			latitude = longitude = ''
+def _friend_row(friend):
+	id_str = friend.id_str
+	screen_name = friend.screen_name
+	name = friend.name
+	profile_url = 'https://twitter.com/' + screen_name
+	profile_image_url = friend.profile_image_url_https.replace('_normal', '_400x400')
+	description = unescape(friend.description)
+
+	return FriendRow(
+		profile_url,
+		profile_image_url,
+		id_str,
+		screen_name,
+		name,
+		description
+	)
+
+
+def user_followers(request, username, count, max_followers):
+	for followers in _api_pages(request, username, count, max_followers):
+		for follower in followers:
+			yield _follower_row(follower)
+
+
+def _follower_row(follower):
+	id_str = follower.id_str
+	screen_name = follower.screen_name
+	name = follower.name
+	profile_url = 'https://twitter.com/' + screen_name
+	profile_image_url = follower.profile_image_url_https.replace('_normal', '_400x400')
+	description = unescape(follower.description)
+
+	return FollowerRow(
+		profile_url,
+		profile_image_url,
+		id_str,
+		screen_name,
+		name,
+		description
+	)
+
+
+def user_favorites(request, username, count, max_favorites, tweet_extended):
+	for statuses in _api_pages(request, username, count, max_favorites, tweet_extended):
+		for status in statuses:
+			yield _favorite_row(status, tweet_extended)
+
+
+def _favorite_row(status, tweet_extended):
+	if tweet_extended:
+		text = unescape(status.full_text)
+	else:
+		text = unescape(status.text)
+
+	screen_name = status.author.screen_name
+	name = status.author.name
+	status_url = 'https://twitter.com/' + screen_name + '/status/' + status.id_str
+	favorite_count = status.favorite_count
+	retweet_count = status.retweet_count
+
+	geo = status.geo
+	if geo:
+		latitude, longitude = geo['coordinates']
+	else:
+		latitude = longitude = ''
+
+	return FavoriteRow(
+		text,
+		status_url,
+		screen_name,
+		name,
+		favorite_count,
+		retweet_count,
+		latitude,
+		longitude
+	)
 
-		table_rows.append([
-			text,
-			status_url,
-			screen_name,
-			name,
-			favorite_count,
-			retweet_count,
-			latitude,
-			longitude
-		])
 
-	return table_rows
+def user_timeline(request, username, count, max_timeline, tweet_extended):
+	for statuses in _api_pages(request, username, count, max_timeline, tweet_extended):
+		for status in statuses:
+			yield _timeline_row(status, tweet_extended)
 
 
-def user_timeline(am, username, count, max_timeline, tweet_extended):
-	statuses = _api_handler(am, _api_timeline, username, count, max_timeline, 'tw', tweet_extended)
+def _timeline_row(status, tweet_extended):
+	created_at = status.created_at.strftime('%Y-%m-%d %H:%M:%S')
 
-	table_rows = []
-	for status in statuses:
-		created_at = status.created_at.strftime('%Y-%m-%d %H:%M:%S')
+	if tweet_extended:
+		text = unescape(status.full_text)
+	else:
+		text = unescape(status.text)
+
+	status_url = 'https://twitter.com/' + status.author.screen_name + '/status/' + status.id_str
+	favorite_count = status.favorite_count
+	retweet_count = status.retweet_count
+
+	geo = status.geo
+	if geo:
+		latitude, longitude = geo['coordinates']
+	else:
+		latitude = longitude = ''
+
+	return TimelineRow(
+		created_at,
+		text,
+		status_url,
+		favorite_count,
+		retweet_count,
+		latitude,
+		longitude
+	)
+
+
+def search_tweets(request, query, count, tweet_extended):
+	for statuses in _api_pages(request, query, count, count, tweet_extended):
+		for status in statuses:
+			yield _search_row(status, tweet_extended)
 
-		if tweet_extended:
-			text = unescape(status.full_text)
+
+def _search_row(status, tweet_extended):
+	created_at = status.created_at.strftime('%Y-%m-%d %H:%M:%S')
+
+	if tweet_extended:
+		text = unescape(status.full_text)
+	else:
+		text = unescape(status.text)
+
+	id_str = status.author.id_str
+	screen_name = status.author.screen_name
+	name = status.author.name
+	status_url = 'https://twitter.com/' + screen_name + '/status/' + status.id_str
+	favorite_count = status.favorite_count
+	retweet_count = status.retweet_count
+
+	geo = status.geo
+	if geo:
+		latitude, longitude = geo['coordinates']
+	else:
+		latitude = longitude = ''
+
+	return SearchRow(
+		created_at,
+		text,
+		status_url,
+		id_str,
+		screen_name,
+		name,
+		favorite_count,
+		retweet_count,
+		latitude,
+		longitude
+	)
+
+
+class Dumper:
+
+	# Library entry point: every section is a lazy iterator of typed rows, pages are only
+	# requested from the API as the caller consumes them
+	#
+	#   with Dumper(credentials, on_progress=...) as dumper:
+	#       for row in dumper.followers('snovvcrash', count=-1):
+	#           sink(row)
+
+	def __init__(self, pool, ledger=None, wait_on_rate_limit=False, tweet_extended=False,
+	             on_progress=None, on_rate_limit=None, on_retry=None, egress_limit=EGRESS_LIMIT):
+		if isinstance(pool, AccountManager):
+			self.am, self._owns_am = pool, False
 		else:
-			text = unescape(status.text)
+			self.am, self._owns_am = AccountManager(pool, ledger=ledger, egress_limit=egress_limit), True
+
+		self._wait_on_rate_limit = wait_on_rate_limit
+		self._tweet_mode = 'extended' if tweet_extended else None
+		self._on_progress = on_progress or _ignore
+		self._on_rate_limit = on_rate_limit or _ignore
+		self._on_retry = on_retry or _ignore
+		self._max_items = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		if self._owns_am:
+			self.am.close()
+
+	def user(self, username):
+		row, self._max_items[username] = user_info(self.request(_api_user, 'user'), username)
+		return row
+
+	def friends(self, username, count=-1):
+		yield from self._section('friends', user_friends, _api_friends, username, count)
+
+	def followers(self, username, count=-1):
+		yield from self._section('followers', user_followers, _api_followers, username, count)
+
+	def favorites(self, username, count=-1):
+		yield from self._section('favorites', user_favorites, _api_favorites, username, count, self._tweet_mode)
+
+	def timeline(self, username, count=-1):
+		yield from self._section('timeline', user_timeline, _api_timeline, username, count, self._tweet_mode)
+
+	def search(self, query, count=-1):
+		# The search index only goes back about a week, count=-1 takes everything it has
+		total = None if count == -1 else count
+		count = sys.maxsize if count == -1 else count
+
+		request = self.request(_api_search, 'search')
+		for got, table_row in enumerate(search_tweets(request, query, count, self._tweet_mode), 1):
+			yield table_row
+			self._on_progress('search', got, total)
+
+	def pages(self, api_method, section, username, count, max_items):
+		# Raw tweepy objects page by page, for callers that need more than the row columns
+		got = 0
+		for page in _api_pages(self.request(api_method, section), username, count, max_items):
+			got += len(page)
+			yield page
+			self._on_progress(section, got, count)
+
+	def request(self, api_method, section):
+		return ApiRequest(
+			self.am,
+			api_method,
+			wait_on_rate_limit=self._wait_on_rate_limit,
+			on_rate_limit=lambda time_to_wait, error: self._on_rate_limit(section, time_to_wait, error),
+			on_retry=lambda delay, error: self._on_retry(section, delay, error)
+		)
+
+	def _section(self, section, build_rows, api_method, username, count, *args):
+		if username not in self._max_items:
+			self.user(username)
+
+		max_items = self._max_items[username][section]
+		if count == -1:
+			count = max_items
+			if section == 'timeline':
+				# From developer.twitter.com: "This method can only return up to 3,200 of a user's most recent Tweets".
+				count = min(count, 3200)
+
+		request = self.request(api_method, section)
+		for got, table_row in enumerate(build_rows(request, username, count, max_items, *args), 1):
+			yield table_row
+			self._on_progress(section, got, count)
+
+
+def dump_profile(dumper, username, friends=0, followers=0, favorites=0, timeline=0, search=0, query=None, on_row=None, printer=None):
+	dump = dict.fromkeys(('user', 'friends', 'followers', 'favorites', 'timeline', 'search'))
+
+	print_info('Collecting basic account info')
+	dump['user'] = dumper.user(username)
+	if on_row:
+		on_row('user', dump['user'])
+
+	if search and not query:
+		# Everything that mentions the user
+		query = '@' + dump['user'].user_login
 
-		status_url = 'https://twitter.com/' + status.author.screen_name + '/status/' + status.id_str
-		favorite_count = status.favorite_count
-		retweet_count = status.retweet_count
+	for section, count in (('friends', friends), ('followers', followers), ('favorites', favorites), ('timeline', timeline), ('search', search)):
+		if not count:
+			continue
 
-		geo = status.geo
-		if geo:
-			latitude, longitude = geo['coordinates']
+		if section == 'search':
+			print_info('Collecting search results for "{}"'.format(query))
+			table_rows = dumper.search(query, count)
 		else:
-			latitude = longitude = ''
+			print_info('Collecting user {} info'.format(section))
+			table_rows = getattr(dumper, section)(username, count)
+
+		dump[section] = RowTable(ROW_TYPES[section])
+		try:
+			for table_row in table_rows:
+				dump[section].append(table_row)
+				if on_row:
+					on_row(section, table_row)
+		except TweetlordError as e:
+			if e.errors['code'] != 2:
+				raise
+			# Keep what was collected and go on with the next section
+			print_warning('{}: {}'.format(section, e), e.errors['initial'], write=tqdm.write)
+		finally:
+			if printer:
+				printer.close()
+
+	return dump
+
+
+def build_summary(dump, top=10):
+	# Aggregates whole columns at once: the per-value work runs inside map/Counter over the
+	# typed arrays of the row tables, so hundreds of 3200-tweet timelines take seconds
+	summary = OrderedDict()
+
+	for section in ('timeline', 'favorites', 'search'):
+		table = dump.get(section)
+		if not table:
+			continue
+
+		stats = summary[section] = OrderedDict(tweets=len(table))
+
+		if 'created_at' in table.row_type._fields:
+			times = table.column('created_at')  # seconds since the epoch
+			days = list(map(operator.floordiv, times, itertools.repeat(24 * 60 * 60)))
+			hours = Counter(map(operator.mod, map(operator.floordiv, times, itertools.repeat(60 * 60)), itertools.repeat(24)))
+			weekdays = Counter(map(operator.mod, map(operator.add, days, itertools.repeat(3)), itertools.repeat(7)))  # 1970-01-01 was a Thursday
+			stats['hours'] = [hours[hour] for hour in range(24)]
+			stats['weekdays'] = [weekdays[day] for day in range(7)]
+
+		if section != 'timeline':
+			# The 'User ID' column of favorites holds the author's screen name
+			stats['top_authors'] = table.counts('user_id' if section == 'favorites' else 'user_login').most_common(top)
+
+		for field in ('favorite_count', 'retweet_count'):
+			stats[field] = _distribution(list(filter(IntColumn.NULL.__ne__, table.column(field))))
+
+		latitudes = table.column('latitude')
+		stats['geo_tagged'] = sum(map(operator.eq, latitudes, latitudes)) / len(table)  # NaN != NaN
+
+	return summary
+
+
+def _distribution(values):
+	# Counts missing from every tweet leave the statistics empty
+	values = sorted(values)
+	bounds = [bisect_left(values, bucket) for bucket in COUNT_BUCKETS] + [len(values)]
+
+	buckets = []
+	for i, bucket in enumerate(COUNT_BUCKETS):
+		if i + 1 == len(COUNT_BUCKETS):
+			label = '{}+'.format(bucket)
+		elif COUNT_BUCKETS[i + 1] - bucket == 1:
+			label = str(bucket)
+		else:
+			label = '{}-{}'.format(bucket, COUNT_BUCKETS[i + 1] - 1)
+		buckets.append((label, bounds[i + 1] - bounds[i]))
+
+	return OrderedDict([
+		('min', values[0] if values else None),
+		('median', values[len(values) // 2] if values else None),
+		('mean', sum(values) / len(values) if values else None),
+		('max', values[-1] if values else None),
+		('buckets', buckets)
+	])
 
-		table_rows.append([
-			created_at,
-			text,
-			status_url,
-			favorite_count,
-			retweet_count,
-			latitude,
-			longitude
-		])
 
-	return table_rows
+def write_summary(summary, filename):
+	with open(filename + '.summary.json', 'w', encoding='utf-8') as f:
+		json.dump(summary, f, ensure_ascii=False, indent=2)
 
 
-def build_xlsx(dump, filename, username):
+def build_xlsx(dump, filename, username, summary=None):
 	workbook = xlsxwriter.Workbook(filename + '.xlsx')
 	worksheet = workbook.add_worksheet(username)
 
@@ -379,9 +687,9 @@ def build_xlsx(dump, filename, username):
 
 	# ------------------------- Other --------------------------
 
-	for titles, dump_part, header in zip((FRIENDS_COLS, FOLLOWERS_COLS, FAVORITES_COLS, TIMELINE_COLS),
-                                         (dump['friends'], dump['followers'], dump['favorites'], dump['timeline']),
-                                         ('Friends', 'Followers', 'Favorites', 'Timeline')):
+	for titles, dump_part, header in zip((FRIENDS_COLS, FOLLOWERS_COLS, FAVORITES_COLS, TIMELINE_COLS, SEARCH_COLS),
+                                         (dump['friends'], dump['followers'], dump['favorites'], dump['timeline'], dump['search']),
+                                         ('Friends', 'Followers', 'Favorites', 'Timeline', 'Search')):
 		if dump_part:
 			worksheet.write(curr_row, 0, '{} ({})'.format(header, len(dump_part)), header_fmt)
 			curr_row += 1
@@ -403,9 +711,310 @@ def build_xlsx(dump, filename, username):
 	for i in range(len(USER_COLS)):  # USER_COLS is max length
 		worksheet.set_column(i, i, max(row_lengths[i]) + 2)
 
+	if summary:
+		_summary_sheet(workbook, summary, header_fmt, col_title_fmt)
+
 	workbook.close()
 
 
+def _summary_sheet(workbook, summary, header_fmt, col_title_fmt):
+	worksheet = workbook.add_worksheet('Summary')
+	percent_fmt = workbook.add_format({'num_format': '0.0%'})
+	curr_row = 0
+
+	for section, stats in summary.items():
+		worksheet.write(curr_row, 0, '{} ({} tweets)'.format(section.capitalize(), stats['tweets']), header_fmt)
+		curr_row += 1
+
+		blocks = []
+		if 'hours' in stats:
+			blocks.append((('Hour (UTC)', 'Tweets'), list(enumerate(stats['hours']))))
+			blocks.append((('Weekday', 'Tweets'), list(zip(WEEKDAYS, stats['weekdays']))))
+		if 'top_authors' in stats:
+			blocks.append((('Author', 'Tweets'), stats['top_authors']))
+
+		favorites, retweets = stats['favorite_count'], stats['retweet_count']
+		blocks.append((('Count', 'Favorite Count', 'Retweet Count'), [
+			(label, favorites_n, retweets_n)
+			for (label, favorites_n), (_, retweets_n) in zip(favorites['buckets'], retweets['buckets'])
+		] + [(key, favorites[key], retweets[key]) for key in ('min', 'median', 'mean', 'max')]))
+
+		col, height = 0, 0
+		for titles, rows in blocks:
+			for i, title in enumerate(titles):
+				worksheet.write(curr_row, col + i, title, col_title_fmt)
+				worksheet.set_column(col + i, col + i, max(len(title), 12) + 2)
+			for j, row in enumerate(rows, 1):
+				for i, elem in enumerate(row):
+					worksheet.write(curr_row + j, col + i, elem)
+			col += len(titles) + 1
+			height = max(height, len(rows))
+
+		worksheet.write(curr_row, col, 'Geo-tagged', col_title_fmt)
+		worksheet.write(curr_row + 1, col, stats['geo_tagged'], percent_fmt)
+		worksheet.set_column(col, col, 14)
+
+		curr_row += height + 5
+
+
+class JsonlSink:
+
+	COLS = {
+		'user': USER_COLS,
+		'friends': FRIENDS_COLS,
+		'followers': FOLLOWERS_COLS,
+		'favorites': FAVORITES_COLS,
+		'timeline': TIMELINE_COLS,
+		'search': SEARCH_COLS
+	}
+
+	def __init__(self, filename):
+		self._file = open(filename + '.jsonl', 'w', encoding='utf-8')
+
+	def write(self, section, table_row):
+		record = {'section': section}
+		record.update(zip(JsonlSink.COLS[section], table_row))
+		self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+	def close(self):
+		self._file.close()
+
+
+class SqliteSink:
+
+	# Normalized tables shared by every dump written to the same database, so questions
+	# across accounts are answered by indexed queries instead of re-reading workbooks.
+	# Rows are buffered and flushed with executemany in one transaction per batch
+
+	BATCH = 1000
+
+	def __init__(self, path, target, query=None):
+		self._conn = sqlite3.connect(path, timeout=60)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.executescript('''
+			CREATE TABLE IF NOT EXISTS runs (
+				id INTEGER PRIMARY KEY,
+				target TEXT NOT NULL,
+				user_id INTEGER,
+				query TEXT,
+				started TEXT NOT NULL,
+				finished TEXT
+			);
+			CREATE TABLE IF NOT EXISTS users (
+				id INTEGER PRIMARY KEY,
+				screen_name TEXT,
+				name TEXT,
+				description TEXT,
+				profile_image_url TEXT,
+				friends_count INTEGER,
+				followers_count INTEGER,
+				statuses_count INTEGER,
+				favorites_count INTEGER,
+				location TEXT,
+				website TEXT,
+				created_at TEXT,
+				run_id INTEGER NOT NULL
+			);
+			CREATE INDEX IF NOT EXISTS users_screen_name ON users (screen_name);
+			CREATE TABLE IF NOT EXISTS edges (
+				src INTEGER NOT NULL,
+				dst INTEGER NOT NULL,
+				run_id INTEGER NOT NULL,
+				PRIMARY KEY (src, dst, run_id)
+			) WITHOUT ROWID;
+			CREATE INDEX IF NOT EXISTS edges_dst ON edges (dst, src);
+			CREATE INDEX IF NOT EXISTS edges_run ON edges (run_id);
+			CREATE TABLE IF NOT EXISTS tweets (
+				id INTEGER PRIMARY KEY,
+				user_id INTEGER,
+				screen_name TEXT,
+				created_at TEXT,
+				text TEXT,
+				favorite_count INTEGER,
+				retweet_count INTEGER,
+				latitude REAL,
+				longitude REAL
+			);
+			CREATE INDEX IF NOT EXISTS tweets_user_id ON tweets (user_id);
+			CREATE INDEX IF NOT EXISTS tweets_screen_name ON tweets (screen_name);
+			CREATE TABLE IF NOT EXISTS run_tweets (
+				run_id INTEGER NOT NULL,
+				section TEXT NOT NULL,
+				tweet_id INTEGER NOT NULL,
+				PRIMARY KEY (run_id, section, tweet_id)
+			) WITHOUT ROWID;
+			CREATE INDEX IF NOT EXISTS run_tweets_tweet_id ON run_tweets (tweet_id);
+		''')
+
+		with self._conn:
+			self.run_id = self._conn.execute(
+				'INSERT INTO runs (target, query, started) VALUES (?, ?, ?)',
+				(target, query, time.strftime('%Y-%m-%d %H:%M:%S'))
+			).lastrowid
+
+		self._user_id = self._user_login = None
+		self._users, self._edges, self._tweets, self._links = [], [], [], []
+
+	def write(self, section, table_row):
+		if section == 'user':
+			self._user_id, self._user_login = int(table_row.user_id), table_row.user_login
+			self._users.append((
+				self._user_id, table_row.user_login, table_row.user_name, table_row.description, table_row.profile_image_url,
+				table_row.friends_count, table_row.followers_count, table_row.statuses_count, table_row.favorites_count,
+				table_row.location, table_row.website, table_row.created_at
+			))
+			with self._conn:
+				self._conn.execute('UPDATE runs SET user_id = ? WHERE id = ?', (self._user_id, self.run_id))
+
+		elif section in ('friends', 'followers'):
+			user_id = int(table_row.user_id)
+			self._users.append((
+				user_id, table_row.user_login, table_row.user_name, table_row.description, table_row.profile_image_url,
+				None, None, None, None, None, None, None
+			))
+			# src follows dst
+			self._edges.append((self._user_id, user_id) if section == 'friends' else (user_id, self._user_id))
+
+		else:
+			tweet_id = int(table_row.tweet_url.rsplit('/', 1)[1])
+			if section == 'timeline':
+				author = (self._user_id, self._user_login)
+			elif section == 'favorites':
+				author = (None, table_row.user_id)  # the 'User ID' column of favorites holds the screen name
+			else:
+				author = (int(table_row.user_id), table_row.user_login)
+			self._tweets.append((
+				tweet_id, author[0], author[1], getattr(table_row, 'created_at', None), table_row.tweet_text,
+				table_row.favorite_count, table_row.retweet_count, _cell(table_row.latitude), _cell(table_row.longitude)
+			))
+			self._links.append((section, tweet_id))
+
+		if len(self._users) + len(self._edges) + len(self._tweets) >= SqliteSink.BATCH:
+			self.flush()
+
+	def flush(self):
+		with self._conn:
+			# Friends/followers rows only know part of the profile, so keep what an earlier full row stored
+			self._conn.executemany(
+				'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+				'screen_name = excluded.screen_name, name = excluded.name, description = excluded.description, '
+				'profile_image_url = excluded.profile_image_url, '
+				'friends_count = COALESCE(excluded.friends_count, friends_count), '
+				'followers_count = COALESCE(excluded.followers_count, followers_count), '
+				'statuses_count = COALESCE(excluded.statuses_count, statuses_count), '
+				'favorites_count = COALESCE(excluded.favorites_count, favorites_count), '
+				'location = COALESCE(excluded.location, location), '
+				'website = COALESCE(excluded.website, website), '
+				'created_at = COALESCE(excluded.created_at, created_at), '
+				'run_id = excluded.run_id',
+				(user + (self.run_id,) for user in self._users)
+			)
+			self._conn.executemany(
+				'INSERT OR IGNORE INTO edges VALUES (?, ?, ?)',
+				((src, dst, self.run_id) for src, dst in self._edges)
+			)
+			self._conn.executemany(
+				'INSERT INTO tweets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+				'user_id = COALESCE(excluded.user_id, user_id), '
+				'screen_name = COALESCE(excluded.screen_name, screen_name), '
+				'created_at = COALESCE(excluded.created_at, created_at), '
+				'text = excluded.text, favorite_count = excluded.favorite_count, retweet_count = excluded.retweet_count, '
+				'latitude = excluded.latitude, longitude = excluded.longitude',
+				self._tweets
+			)
+			self._conn.executemany(
+				'INSERT OR IGNORE INTO run_tweets VALUES (?, ?, ?)',
+				((self.run_id, section, tweet_id) for section, tweet_id in self._links)
+			)
+
+		self._users, self._edges, self._tweets, self._links = [], [], [], []
+
+	def close(self):
+		self.flush()
+		with self._conn:
+			self._conn.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.strftime('%Y-%m-%d %H:%M:%S'), self.run_id))
+		self._conn.close()
+
+
+def _cell(value):
+	# Empty cells ('', no geo) become NULL, 0 and 0.0 are real coordinates
+	return None if value == '' else value
+
+
+class ImageDownloader:
+
+	# Fetches profile images on a background pool while the dump goes on; images are stored
+	# once per content hash, so the same avatar behind different URLs is kept only once.
+	# Submitting blocks while BACKLOG downloads per worker are pending, and the index row of
+	# an image is written as soon as it is done, so nothing piles up on huge follower lists
+
+	SECTIONS = ('user', 'friends', 'followers')
+	BACKLOG = 4
+
+	def __init__(self, store_dir, filename, workers=8):
+		self._store_dir = store_dir
+		self._session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+		self._session.mount('https://', adapter)
+		self._session.mount('http://', adapter)
+		self._executor = ThreadPoolExecutor(max_workers=workers)
+		self._pending = threading.BoundedSemaphore(workers * ImageDownloader.BACKLOG)
+		self._seen = set()
+
+		self._lock = threading.Lock()
+		self._stats = {'downloaded': 0, 'duplicate': 0, 'failed': 0}
+		self._index = open(filename + '.images.csv', 'w', newline='', encoding='utf-8')
+		self._writer = csv.writer(self._index)
+		self._writer.writerow(['Profile Image URL', 'SHA-256', 'Path', 'Status'])
+
+	def submit(self, section, table_row):
+		if section not in ImageDownloader.SECTIONS:
+			return
+
+		url = table_row[1]  # 'Profile Image URL'
+		if url and url not in self._seen:
+			self._seen.add(url)
+			self._pending.acquire()
+			self._executor.submit(self._fetch, url).add_done_callback(lambda future: self._done(url, future))
+
+	def close(self):
+		self._executor.shutdown()
+		self._index.close()
+		self._session.close()
+		return self._stats
+
+	def _done(self, url, future):
+		try:
+			try:
+				digest, path, status = future.result()
+			except (requests.RequestException, OSError) as e:
+				print_warning('{}: Download failed'.format(url), str(e), write=tqdm.write)
+				digest, path, status = '', '', 'failed'
+			with self._lock:
+				self._stats[status] += 1
+				self._writer.writerow([url, digest, path, status])
+		finally:
+			self._pending.release()
+
+	def _fetch(self, url):
+		resp = self._session.get(url, timeout=30)
+		resp.raise_for_status()
+
+		digest = hashlib.sha256(resp.content).hexdigest()
+		ext = os.path.splitext(url.rsplit('/', 1)[-1])[1] or '.jpg'
+		path = os.path.join(self._store_dir, digest[:2], digest + ext)
+		if os.path.exists(path):
+			return (digest, path, 'duplicate')
+
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+		with open(tmp_path, 'wb') as f:
+			f.write(resp.content)
+		os.replace(tmp_path, path)
+
+		return (digest, path, 'downloaded')
+
+
 def show_limits(client):
 	limits = client.rate_limit_status()
 
@@ -450,17 +1059,256 @@ def show_limits(client):
 	reset = d['reset'] - int(datetime.datetime.timestamp(datetime.datetime.now()))
 	print('[5] api.user_timeline     -- limit: {}, remaining: {}, reset: {} m {} s'.format(limit, remaining, reset // 60, reset % 60))
 
-	# _d = limits['resources']['users'].get('/users/search', None)
-	# _limit = d['limit']
-	# _remaining = d['remaining']
-	# _reset = d['reset'] - int(datetime.datetime.timestamp(datetime.datetime.now()))
-	# _print('[6] api.search_users -- \"limit\": {}, \"remaining\": {}, \"reset\": {} m {} s'.format(limit, remaining, reset // 60, reset % 60))
+	d = limits['resources']['search']['/search/tweets']
+	limit = d['limit']
+	remaining = d['remaining']
+	reset = d['reset'] - int(datetime.datetime.timestamp(datetime.datetime.now()))
+	print('[6] api.search            -- limit: {}, remaining: {}, reset: {} m {} s'.format(limit, remaining, reset // 60, reset % 60))
+
+
+# ----------------------------------------------------------
+# ------------------------- Tables -------------------------
+# ----------------------------------------------------------
+
+
+class RowTable:
+
+	# Holds the rows of one section column by column: numbers in typed arrays, text packed
+	# into one UTF-8 buffer, repeated values (authors, URL prefixes) stored once. Rows come
+	# back as the same namedtuples that went in
+
+	def __init__(self, row_type):
+		self.row_type = row_type
+		self._columns = [column() for column in TABLE_COLUMNS[row_type]]
+		self._len = 0
+
+	def append(self, table_row):
+		for column, value in zip(self._columns, table_row):
+			column.append(value)
+		self._len += 1
+
+	def extend(self, table_rows):
+		for table_row in table_rows:
+			self.append(table_row)
+
+	def column(self, field):
+		# Raw column values, e. g. the array of favorite counts for analytics
+		return self._columns[self.row_type._fields.index(field)].values
+
+	def counts(self, field):
+		column = self._columns[self.row_type._fields.index(field)]
+		if isinstance(column, RefColumn):
+			return Counter({column.refs[code]: n for code, n in Counter(column.codes).items()})
+		return Counter(column)
+
+	def __len__(self):
+		return self._len
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self._len
+		if not 0 <= i < self._len:
+			raise IndexError('row index out of range')
+		return self.row_type(*(column[i] for column in self._columns))
+
+	def __iter__(self):
+		return map(self.row_type._make, zip(*self._columns))
+
+	def __bool__(self):
+		return self._len > 0
+
+
+class IntColumn:
+
+	# Missing counts (None) are stored as NULL
+
+	NULL = -2 ** 63
+
+	def __init__(self):
+		self.values = array('q')
+
+	def append(self, value):
+		self.values.append(IntColumn.NULL if value is None else value)
+
+	def __getitem__(self, i):
+		value = self.values[i]
+		return None if value == IntColumn.NULL else value
+
+	def __iter__(self):
+		return ((None if value == IntColumn.NULL else value) for value in self.values)
+
+
+class IdColumn(IntColumn):
+
+	# Twitter IDs are kept as strings in the rows
+
+	def append(self, value):
+		self.values.append(int(value))
+
+	def __getitem__(self, i):
+		return str(self.values[i])
+
+	def __iter__(self):
+		return map(str, self.values)
+
+
+class FloatColumn:
+
+	# Empty cells (no geo) are stored as NaN. Coordinates that came as ints are given back
+	# as ints, so the rows (and the workbook) stay exactly as they were
+
+	def __init__(self):
+		self.values = array('d')
+		self._ints = set()
+
+	def append(self, value):
+		if value == '':
+			value = float('nan')
+		elif isinstance(value, int):
+			self._ints.add(len(self.values))
+		self.values.append(value)
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self.values)
+		return self._value(i, self.values[i])
+
+	def __iter__(self):
+		return itertools.starmap(self._value, enumerate(self.values))
+
+	def _value(self, i, value):
+		if value != value:
+			return ''
+		return int(value) if i in self._ints else value
+
+
+class TimeColumn(IntColumn):
+
+	# '%Y-%m-%d %H:%M:%S' timestamps as seconds since the epoch
+
+	EPOCH = datetime.datetime(1970, 1, 1)
+
+	def append(self, value):
+		self.values.append(int((datetime.datetime.fromisoformat(value) - TimeColumn.EPOCH).total_seconds()))
+
+	def __getitem__(self, i):
+		return str(TimeColumn.EPOCH + datetime.timedelta(seconds=self.values[i]))
+
+	def __iter__(self):
+		return (str(TimeColumn.EPOCH + datetime.timedelta(seconds=value)) for value in self.values)
+
+
+class StrColumn:
+
+	def __init__(self):
+		self._data = bytearray()
+		self._ends = array('Q')
+
+	def append(self, value):
+		self._data += value.encode('utf-8')
+		self._ends.append(len(self._data))
 
-	# _d = limits['resources']['search'].get('/search/tweets', None)
-	# _limit = d['limit']
-	# _remaining = d['remaining']
-	# _reset = d['reset'] - int(datetime.datetime.timestamp(datetime.datetime.now()))
-	# _print('[7] api.search -- \"limit\": {}, \"remaining\": {}, \"reset\": {} m {} s'.format(limit, remaining, reset // 60, reset % 60))
+	@property
+	def values(self):
+		return list(self)
+
+	def __getitem__(self, i):
+		start = self._ends[i - 1] if i else 0
+		return self._data[start:self._ends[i]].decode('utf-8')
+
+	def __iter__(self):
+		start = 0
+		for end in self._ends:
+			yield self._data[start:end].decode('utf-8')
+			start = end
+
+
+class RefColumn:
+
+	# Every distinct value is stored once and referenced by its index
+
+	def __init__(self):
+		self._index = {}
+		self.refs = []
+		self.codes = array('L')
+
+	def append(self, value):
+		code = self._index.get(value)
+		if code is None:
+			code = self._index[value] = len(self.refs)
+			self.refs.append(value)
+		self.codes.append(code)
+
+	@property
+	def values(self):
+		return list(self)
+
+	def __getitem__(self, i):
+		return self.refs[self.codes[i]]
+
+	def __iter__(self):
+		return map(self.refs.__getitem__, self.codes)
+
+
+class UrlColumn:
+
+	# Profile and image URLs: the well-known host part is stored as a one-byte code
+
+	PREFIXES = ('', 'https://twitter.com/', 'https://pbs.twimg.com/profile_images/', 'https://abs.twimg.com/')
+
+	def __init__(self):
+		self._prefixes = array('B')
+		self._tails = StrColumn()
+
+	def append(self, value):
+		code = max((i for i, prefix in enumerate(UrlColumn.PREFIXES) if value.startswith(prefix)), key=lambda i: len(UrlColumn.PREFIXES[i]))
+		self._prefixes.append(code)
+		self._tails.append(value[len(UrlColumn.PREFIXES[code]):])
+
+	@property
+	def values(self):
+		return list(self)
+
+	def __getitem__(self, i):
+		return UrlColumn.PREFIXES[self._prefixes[i]] + self._tails[i]
+
+	def __iter__(self):
+		return (UrlColumn.PREFIXES[code] + tail for code, tail in zip(self._prefixes, self._tails))
+
+
+class StatusUrlColumn:
+
+	# Tweet URLs: "https://twitter.com/<login>/status" is shared by every tweet of an author,
+	# the tweet ID goes to a typed array
+
+	def __init__(self):
+		self._prefixes = RefColumn()
+		self._ids = array('q')
+
+	def append(self, value):
+		prefix, _, id_str = value.rpartition('/')
+		self._prefixes.append(prefix)
+		self._ids.append(int(id_str))
+
+	@property
+	def values(self):
+		return list(self)
+
+	def __getitem__(self, i):
+		return '{}/{}'.format(self._prefixes[i], self._ids[i])
+
+	def __iter__(self):
+		return ('{}/{}'.format(prefix, id_) for prefix, id_ in zip(self._prefixes, self._ids))
+
+
+TABLE_COLUMNS = {
+	FriendRow: (UrlColumn, UrlColumn, IdColumn, StrColumn, StrColumn, StrColumn),
+	FollowerRow: (UrlColumn, UrlColumn, IdColumn, StrColumn, StrColumn, StrColumn),
+	# The 'User ID' and 'User Login' columns of favorites hold the author's screen name and name
+	FavoriteRow: (StrColumn, StatusUrlColumn, RefColumn, RefColumn, IntColumn, IntColumn, FloatColumn, FloatColumn),
+	TimelineRow: (TimeColumn, StrColumn, StatusUrlColumn, IntColumn, IntColumn, FloatColumn, FloatColumn),
+	SearchRow: (TimeColumn, StrColumn, StatusUrlColumn, IdColumn, RefColumn, RefColumn, IntColumn, IntColumn, FloatColumn, FloatColumn)
+}
 
 
 # ----------------------------------------------------------
@@ -468,137 +1316,190 @@ def show_limits(client):
 # ----------------------------------------------------------
 
 
-def _api_handler(am, api_method, username, count=None, max_items=0, unit='', tweet_extended=False):
-	api_method_name = PROC_NAMES[api_method.__name__]
-	api_section_name = SECTION_NAMES[api_method_name]
+class ApiRequest:
 
-	cred, time_to_wait = am.get(api_section_name)
-	modes, curr_mode = ['app', 'user'], 0
+	# Credential, auth mode and retry state of one API method while it is being paged through
 
-	if count is None:  # api_method == _api_user
-		while True:
-			client = tweepy_auth(cred, mode=modes[curr_mode])
-			try:
-				return api_method(client, username)
-			except (tweepy.error.TweepError, tweepy.error.RateLimitError) as e:
-				if e.response.status_code == 404:
-					raise TweetlordError('User not found', errors={'code': 1, 'initial': str(e)})
-				curr_mode = 1 - curr_mode
-				if not curr_mode:
-					cred, time_to_wait = am.get(api_section_name)
-					if time_to_wait <= 0:
-						print('[*] Account switched')
-					elif WAIT_ON_RATE_LIMIT:
-						print('[*] It\'s {} on the clock'.format(time.strftime('%H:%M:%S', time.localtime())))
-						print_warning(
-							'{}: Rate limit exceeded, all accounts are empty. Waiting {} minutes {} seconds'
-							.format(api_method_name, time_to_wait // 60, time_to_wait % 60), str(e)
-						)
-						try:
-							time.sleep(time_to_wait)
-						except KeyboardInterrupt:
-							cprint('{}: Stopped'.format(api_method_name), 'white', 'on_red', attrs=['bold'])
-							break
-					else:
-						raise TweetlordError('Rate limit exceeded, all accounts are empty', errors={'code': 2, 'initial': str(e)})
-
-	max_per_page = 200
-	full_pages = count // max_per_page
-	items_remaining = count % max_per_page
-
-	start_page = -1 if api_method in (_api_friends, _api_followers) else 0
-	items = []
-
-	with tqdm(total=count, ncols=80, unit=unit, desc='    got') as pbar:
-		while full_pages:
-			client = tweepy_auth(cred, mode=modes[curr_mode])
-			cursor = api_method(
-				client,
-				username,
-				page=start_page,
-				count=max_per_page,
-				pages_count=full_pages,
-				tweet_extended=tweet_extended
-			)
+	MODES = ['app', 'user']
 
+	def __init__(self, am, api_method, wait_on_rate_limit=False, on_rate_limit=None, on_retry=None):
+		self.am = am
+		self.api_method = api_method
+		self.api_method_name = PROC_NAMES[api_method.__name__]
+		self.api_section_name = SECTION_NAMES[self.api_method_name]
+
+		self._wait_on_rate_limit = wait_on_rate_limit
+		self._on_rate_limit = on_rate_limit or _ignore
+		self._on_retry = on_retry or _ignore
+
+		self._attempt = 0
+		self._switch_account()
+
+	def call(self, username, **kwargs):
+		if not self.am.allows(self.cred):
+			# Quarantined since it was picked (e. g. by another request), take the best healthy one
+			self._switch_account()
+		elif self.am.has_faster(self.api_section_name, self.cred):
+			self._switch_account()
+
+		while True:
+			mode = self._modes[self._curr_mode]
+			client = self.am.client(self.cred, mode)
 			try:
-				for page in cursor:
-					items += page
-					start_page = cursor.next_cursor if api_method in (_api_friends, _api_followers) else start_page + 1
-					full_pages -= 1
-					pbar.update(max_per_page)
+				with self.am.egress(self.cred).request():
+					started = time.time()
+					result = self.api_method(client, username, **kwargs)
 			except (tweepy.error.TweepError, tweepy.error.RateLimitError) as e:
-				if e.response.status_code == 404:
-					raise TweetlordError('User not found', errors={'code': -1, 'initial': str(e)})
-				curr_mode = 1 - curr_mode
-				if not curr_mode:
-					cred, time_to_wait = am.get(api_section_name)
-					if time_to_wait <= 0:
-						pbar.write('[*] Account switched')
-					elif WAIT_ON_RATE_LIMIT:
-						pbar.write('[*] It\'s {} on the clock'.format(time.strftime('%H:%M:%S', time.localtime())))
-						print_warning(
-							'{}: Rate limit exceeded, all accounts are empty. Waiting {} minutes {} seconds'
-							.format(api_method_name, time_to_wait // 60, time_to_wait % 60), str(e), write=pbar.write
-						)
-						try:
-							time.sleep(time_to_wait)
-						except KeyboardInterrupt:
-							pbar.write(colored('{}: Stopped'.format(api_method_name), 'white', 'on_red', attrs=['bold']))
-							break
-					else:
-						print_warning(
-							'{}: Rate limit exceeded, all accounts are empty'
-							.format(api_method_name), str(e), write=pbar.write
-						)
-						return items
-				else:
-					full_pages = 0
-
-		if len(items) < max_items:
-			while items_remaining:
-				client = tweepy_auth(cred, mode=modes[curr_mode])
-				cursor = api_method(
-					client,
-					username,
-					page=start_page,
-					count=items_remaining,
-					pages_count=1,
-					tweet_extended=tweet_extended
-				)
-
-				try:
-					items += flatten(list(cursor))
-					pbar.update(items_remaining)
-				except (tweepy.error.TweepError, tweepy.error.RateLimitError) as e:
-					if e.response.status_code == 404:
-						raise TweetlordError('User not found', errors={'code': -1, 'initial': str(e)})
-					curr_mode = 1 - curr_mode
-					if not curr_mode:
-						cred, time_to_wait = am.get(api_section_name)
-						if time_to_wait <= 0:
-							pbar.write('[*] Account switched')
-						elif WAIT_ON_RATE_LIMIT:
-							pbar.write('[*] It\'s {} on the clock'.format(time.strftime('%H:%M:%S', time.localtime())))
-							print_warning(
-								'{}: Rate limit exceeded, all accounts are empty. Waiting {} minutes {} seconds'
-								.format(api_method_name, time_to_wait // 60, time_to_wait % 60), str(e), write=pbar.write
-							)
-							try:
-								time.sleep(time_to_wait)
-							except KeyboardInterrupt:
-								pbar.write(colored('{}: Stopped'.format(api_method_name), 'white', 'on_red', attrs=['bold']))
-								break
-						else:
-							print_warning(
-								'{}: Rate limit exceeded, all accounts are empty'
-								.format(api_method_name), str(e), write=pbar.write
-							)
-							return items
-				else:
-					items_remaining = 0
-
-	return items
+				give_up = self._on_error(e, mode, time.time() - started)
+				if give_up:
+					kind, reason = give_up
+					raise TweetlordError(reason, errors={'code': 2, 'kind': kind, 'initial': str(e)})
+			else:
+				self.am.consume(self.api_section_name, self.cred)
+				self.am.report(self.cred, latency=time.time() - started)
+				self._attempt = 0
+				return result
+
+	def _switch_account(self, exhausted=None):
+		self.cred, self._time_to_wait = self.am.get(self.api_section_name, exhausted=exhausted)
+		self._modes = self.am.modes(self.cred)
+		self._curr_mode = 0
+
+	def _next_mode(self):
+		# Tries the other auth mode of the account, False once both were tried
+		self._curr_mode = (self._curr_mode + 1) % len(self._modes)
+		return self._curr_mode != 0
+
+	def _wait_quarantine(self, e):
+		# The account that took over from a failing one is quarantined too, so every account
+		# is: that's reported as a failure, not as an empty rate limit
+		if not self._wait_on_rate_limit:
+			return ('quarantined', 'All accounts are quarantined after repeated errors')
+
+		self._on_retry(self._time_to_wait, e)
+		try:
+			time.sleep(self._time_to_wait)
+		except KeyboardInterrupt:
+			return ('stopped', 'Stopped')
+
+		self._modes = self.am.modes(self.cred)
+		self._curr_mode = 0
+		if not self._modes:
+			self._switch_account()
+		return None
+
+	def _on_error(self, e, mode, latency):
+		# Returns None when the request should be repeated, or the kind of and reason for giving up
+		kind = classify_error(e)
+		if kind == 'not_found':
+			raise TweetlordError('User not found', errors={'code': 1 if self.api_method is _api_user else -1, 'initial': str(e)})
+
+		if kind == 'transient':
+			self._attempt += 1
+			if self.am.report(self.cred, latency=latency, error=kind):
+				delay = backoff_delay(self._attempt)
+				self._on_retry(delay, e)
+				time.sleep(delay)
+				return None
+
+			# The account is quarantined, let another one take over
+			self._switch_account()
+			self._attempt = 0
+			if not self.am.allows(self.cred):
+				return self._wait_quarantine(e)
+			if self._time_to_wait <= 0:
+				return None
+
+		elif kind == 'revoked':
+			# The account can't authenticate in this mode: don't try it again for a while
+			if self.am.report(self.cred, error=kind, mode=mode):
+				self._modes.remove(mode)
+				self._curr_mode = 0
+				return None
+			self._switch_account()
+			self._attempt = 0
+			if not self.am.allows(self.cred):
+				return self._wait_quarantine(e)
+			if self._time_to_wait <= 0:
+				return None
+
+		elif kind == 'denied':
+			if self._next_mode():
+				return None
+			return ('denied', 'Access denied')
+
+		else:  # kind == 'rate_limit'
+			if self._next_mode():
+				return None
+			self._switch_account(exhausted=self.cred)
+			self._attempt = 0
+
+		self._on_rate_limit(max(self._time_to_wait, 0), e)
+		if self._time_to_wait <= 0:
+			return None
+
+		if not self._wait_on_rate_limit:
+			return ('rate_limit', 'Rate limit exceeded, all accounts are empty')
+
+		try:
+			time.sleep(self._time_to_wait)
+		except KeyboardInterrupt:
+			return ('stopped', 'Stopped')
+
+		# Auth modes may have been revoked or have come back in the meantime
+		self._modes = self.am.modes(self.cred)
+		self._curr_mode = 0
+		if not self._modes:
+			self._switch_account()
+		return None
+
+
+def _api_pages(request, username, count, max_items, tweet_extended=None):
+	max_per_page = 100 if request.api_method is _api_search else 200
+	position = -1 if request.api_method in (_api_friends, _api_followers) else None
+	seen_ids = set() if request.api_method in (_api_favorites, _api_timeline, _api_search) else None
+	got = 0
+
+	while got < count:
+		# Always ask for a full page: the remainder is cut from the last one instead of costing an extra call
+		page, next_position = request.call(
+			username,
+			position=position,
+			count=max_per_page,
+			tweet_extended=tweet_extended
+		)
+
+		if seen_ids is not None:
+			page = [status for status in page if status.id not in seen_ids]
+			seen_ids.update(status.id for status in page)
+
+		page = page[:count - got]
+		got += len(page)
+		yield page
+
+		if next_position is None or got >= max_items:
+			break
+		position = next_position
+
+
+def classify_error(e):
+	response = getattr(e, 'response', None)
+	status_code = response.status_code if response is not None else None
+
+	if status_code == 404:
+		return 'not_found'
+	if isinstance(e, tweepy.error.RateLimitError) or status_code in (420, 429) or getattr(e, 'api_code', None) == 88:
+		return 'rate_limit'
+	if status_code is None or status_code >= 500:  # connection reset, timeout, 5xx
+		return 'transient'
+	if getattr(e, 'api_code', None) in REVOKED_API_CODES:
+		return 'revoked'
+	return 'denied'
+
+
+def backoff_delay(attempt):
+	# Exponential backoff with full jitter
+	return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
 
 
 def _api_user(client, username, **kwargs):
@@ -611,97 +1512,73 @@ def _api_user(client, username, **kwargs):
 
 
 def _api_friends(client, username, **kwargs):
-	if username.startswith('id'):
-		user_id = username[2:]
-		return tweepy.Cursor(
-			client.friends,
-			user_id=user_id,
-			cursor=kwargs['page'],
-			count=kwargs['count'],
-			skip_status=True,
-			include_user_entities=False
-		).pages(kwargs['pages_count'])
-
-	screen_name = username
-	return tweepy.Cursor(
-		client.friends,
-		screen_name=screen_name,
-		cursor=kwargs['page'],
+	friends, (_, next_cursor) = client.friends(
+		cursor=kwargs['position'],
 		count=kwargs['count'],
 		skip_status=True,
-		include_user_entities=False
-	).pages(kwargs['pages_count'])
+		include_user_entities=False,
+		**_user_param(username)
+	)
 
+	return (friends, next_cursor or None)
 
-def _api_followers(client, username, **kwargs):
-	if username.startswith('id'):
-		user_id = username[2:]
-		return tweepy.Cursor(
-			client.followers,
-			user_id=user_id,
-			cursor=kwargs['page'],
-			count=kwargs['count'],
-			skip_status=True,
-			include_user_entities=False
-		).pages(kwargs['pages_count'])
 
-	screen_name = username
-	return tweepy.Cursor(
-		client.followers,
-		screen_name=screen_name,
-		cursor=kwargs['page'],
+def _api_followers(client, username, **kwargs):
+	followers, (_, next_cursor) = client.followers(
+		cursor=kwargs['position'],
 		count=kwargs['count'],
 		skip_status=True,
-		include_user_entities=False
-	).pages(kwargs['pages_count'])
+		include_user_entities=False,
+		**_user_param(username)
+	)
 
+	return (followers, next_cursor or None)
 
-def _api_favorites(client, username, **kwargs):
-	if username.startswith('id'):
-		user_id = username[2:]
-		return tweepy.Cursor(
-			client.favorites,
-			user_id=user_id,
-			page=kwargs['page'],
-			count=kwargs['count'],
-			include_entities=False,
-			tweet_mode=kwargs['tweet_extended']
-		).pages(kwargs['pages_count'])
 
-	screen_name = username
-	return tweepy.Cursor(
-		client.favorites,
-		screen_name=screen_name,
-		page=kwargs['page'],
+def _api_favorites(client, username, **kwargs):
+	statuses = client.favorites(
 		count=kwargs['count'],
 		include_entities=False,
-		tweet_mode=kwargs['tweet_extended']
-	).pages(kwargs['pages_count'])
+		tweet_mode=kwargs['tweet_extended'],
+		**_user_param(username, max_id=kwargs['position'])
+	)
 
+	return (statuses, min(status.id for status in statuses) - 1 if statuses else None)
 
-def _api_timeline(client, username, **kwargs):
-	if username.startswith('id'):
-		user_id = username[2:]
-		return tweepy.Cursor(
-			client.user_timeline,
-			user_id=user_id,
-			count=kwargs['count'],
-			trim_user=False,
-			exclude_replies=False,
-			include_rts=True,
-			tweet_mode=kwargs['tweet_extended']
-		).pages(kwargs['pages_count'])
 
-	screen_name = username
-	return tweepy.Cursor(
-		client.user_timeline,
-		screen_name=screen_name,
+def _api_timeline(client, username, **kwargs):
+	statuses = client.user_timeline(
 		count=kwargs['count'],
 		trim_user=False,
 		exclude_replies=False,
 		include_rts=True,
-		tweet_mode=kwargs['tweet_extended']
-	).pages(kwargs['pages_count'])
+		tweet_mode=kwargs['tweet_extended'],
+		**_user_param(username, max_id=kwargs['position'])
+	)
+
+	return (statuses, min(status.id for status in statuses) - 1 if statuses else None)
+
+
+def _api_search(client, query, **kwargs):
+	params = {'max_id': kwargs['position']} if kwargs['position'] is not None else {}
+	statuses = client.search(
+		q=query,
+		count=kwargs['count'],
+		result_type='recent',
+		include_entities=False,
+		tweet_mode=kwargs['tweet_extended'],
+		**params
+	)
+
+	return (statuses, min(status.id for status in statuses) - 1 if statuses else None)
+
+
+def _user_param(username, max_id=None):
+	# "id"-prefixed usernames are account IDs, the rest are screen names
+	params = {'user_id': username[2:]} if username.startswith('id') else {'screen_name': username}
+	if max_id is not None:
+		params['max_id'] = max_id
+	return params
 
 
 # ----------------------------------------------------------
@@ -710,13 +1587,78 @@ def _api_timeline(client, username, **kwargs):
 
 
 def tweepy_auth(cred, mode):
+	proxy = cred.get('proxy', '')
+
 	auth = None
 	if mode == 'user':
 		auth = tweepy.OAuthHandler(cred['consumer_key'], cred['consumer_secret'])
 		auth.set_access_token(cred['access_token_key'], cred['access_token_secret'])
 	elif mode == 'app':
-		auth = tweepy.AppAuthHandler(cred['consumer_key'], cred['consumer_secret'])
-	return tweepy.API(auth, wait_on_rate_limit=False) if auth else None
+		# The bearer token is fetched right away: a dead proxy or an error page shows up here
+		try:
+			if proxy:
+				with proxy_session(proxy) as session:
+					auth = ProxiedAppAuthHandler(cred['consumer_key'], cred['consumer_secret'], session)
+			else:
+				auth = tweepy.AppAuthHandler(cred['consumer_key'], cred['consumer_secret'])
+		except (requests.RequestException, ValueError, tweepy.error.TweepError) as e:
+			raise TweetlordError(
+				'Could not get the app-auth token of account {} through {}'.format(cred_id(cred), egress_name(proxy)),
+				errors={'code': 4, 'initial': str(e)}
+			)
+	return tweepy.API(auth, wait_on_rate_limit=False, proxy=proxy) if auth else None
+
+
+def proxy_session(proxy):
+	# API calls get the proxy through tweepy.API, this is only for the app-auth token request
+	session = requests.Session()
+	session.proxies = {'http': proxy, 'https': proxy}
+	return session
+
+
+def check_proxy(cred):
+	proxy = cred.get('proxy')
+	if not proxy:
+		return
+
+	url = urlsplit(proxy)
+	try:
+		url.port
+	except ValueError:
+		hostname = None
+	else:
+		hostname = url.hostname
+
+	if url.scheme not in PROXY_SCHEMES or not hostname:
+		raise TweetlordError(
+			'Invalid proxy of account {}: expected scheme://[user:password@]host:port with one of the schemes {}'.format(
+				cred_id(cred), ', '.join(PROXY_SCHEMES)
+			),
+			errors={'code': 4}
+		)
+
+
+class ProxiedAppAuthHandler(tweepy.AppAuthHandler):
+
+	# tweepy fetches the app-auth bearer token with a bare requests.post, which would leave
+	# through the default route; this one asks for it through the account's own session
+
+	def __init__(self, consumer_key, consumer_secret, session):
+		self.consumer_key = consumer_key
+		self.consumer_secret = consumer_secret
+		self._bearer_token = ''
+
+		resp = session.post(
+			self._get_oauth_url('token'),
+			auth=(consumer_key, consumer_secret),
+			data={'grant_type': 'client_credentials'},
+			timeout=60
+		)
+		data = resp.json()
+		if data.get('token_type') != 'bearer':
+			raise tweepy.error.TweepError('Expected token_type to equal "bearer", but got {} instead'.format(data.get('token_type')))
+
+		self._bearer_token = data['access_token']
 
 
 # ----------------------------------------------------------
@@ -726,20 +1668,38 @@ def tweepy_auth(cred, mode):
 
 class AccountManager:
 
+	# Share of the current account's score another one has to beat to take over mid-section
+	SWITCH_RATIO = 0.5
+
 	METHODS = {
 		'users': '/users/show/:id',
 		'friends': '/friends/list',
 		'followers': '/followers/list',
 		'favorites': '/favorites/list',
-		'statuses': '/statuses/user_timeline'
+		'statuses': '/statuses/user_timeline',
+		'search': '/search/tweets'
 	}
 
-	def __init__(self, credentials):
+	def __init__(self, credentials, ledger=None, egress_limit=EGRESS_LIMIT):
 		unique_creds = {json.dumps(cred) for cred in credentials}
 
 		self._creds = [json.loads(cred) for cred in unique_creds]
-		self._app_clients = [tweepy_auth(cred, mode='app') for cred in self._creds]
-		self._user_clients = [tweepy_auth(cred, mode='user') for cred in self._creds]
+		self._cred_ids = [cred_id(cred) for cred in self._creds]
+
+		# Accounts behind the same proxy share its egress
+		self._egresses = OrderedDict()
+		for cred in self._creds:
+			check_proxy(cred)
+			name = egress_name(cred.get('proxy'))
+			if name not in self._egresses:
+				self._egresses[name] = Egress(name, egress_limit)
+
+		self._app_clients = [tweepy_auth(cred, 'app') for cred in self._creds]
+		self._user_clients = [tweepy_auth(cred, 'user') for cred in self._creds]
+
+		self._ledger = ledger
+		self._lock = threading.RLock()
+		self._health = {cred_id(cred): CredentialHealth() for cred in self._creds}
 
 		self._app_limits, self._user_limits = self._build_limits()
 
@@ -747,24 +1707,143 @@ class AccountManager:
 		for section in AccountManager.METHODS:
 			self._queues[section] = self._build_queue(section, AccountManager.METHODS[section])
 
-	def get(self, section):
-		if self._queues[section].empty():
-			self._app_limits, self._user_limits = self._build_limits()
-			self._queues[section] = self._build_queue(section, AccountManager.METHODS[section])
+	def get(self, section, exhausted=None):
+		with self._lock:
+			if self._ledger is not None:
+				return self._get_leased(section, exhausted)
+
+			# The fastest healthy account with budget goes first. Entries stay in the queue and
+			# their budget is charged by consume(), so the limits are only probed again once all
+			# of them look empty
+			entries = self._queues[section].queue
+			if exhausted is not None:
+				self._charge(section, exhausted, None)
+
+			usable = [entry for entry in entries if self._health[cred_id(entry[3])].allows()]
+			if not usable:
+				return self._least_quarantined()
+
+			if all(entry[0] == 0 for entry in usable):
+				self._app_limits, self._user_limits = self._build_limits()
+				self._queues[section] = self._build_queue(section, AccountManager.METHODS[section])
+				entries = self._queues[section].queue
+				usable = [entry for entry in entries if self._health[cred_id(entry[3])].allows()]
+
+			limit, reset, _, account = min(usable, key=lambda entry: (entry[0] == 0, self._health[cred_id(entry[3])].score(), entry))
 
-		limit, reset, account = self._queues[section].get()
 		if limit:
 			return (account, 0)
 
 		time_to_wait = reset - int(datetime.datetime.timestamp(datetime.datetime.now()))
 		return (account, time_to_wait)
 
+	def report(self, account, latency=None, error=None, mode=None):
+		with self._lock:
+			health = self._health[cred_id(account)]
+			if error:
+				health.failure(error, latency, mode)
+			else:
+				health.success(latency)
+			return health.allows()
+
+	def allows(self, account):
+		with self._lock:
+			return self._health[cred_id(account)].allows()
+
+	def has_faster(self, section, account):
+		# Whether another healthy account with budget scores clearly better than the one in
+		# use. The ledger keeps the budget of leased accounts, so there any healthy one counts
+		with self._lock:
+			if self._ledger is not None:
+				candidates = self._cred_ids
+			else:
+				candidates = [cred_id(entry[3]) for entry in self._queues[section].queue if entry[0] < 0]
+
+			scores = [self._health[i].score() for i in candidates if i != cred_id(account) and self._health[i].allows()]
+			return bool(scores) and min(scores) < self._health[cred_id(account)].score() * AccountManager.SWITCH_RATIO
+
+	def modes(self, account):
+		with self._lock:
+			return self._health[cred_id(account)].modes()
+
+	def health(self):
+		with self._lock:
+			return [
+				dict(self._health[i].stats(), account=i, egress=egress_name(cred.get('proxy')))
+				for i, cred in zip(self._cred_ids, self._creds)
+			]
+
+	def egress(self, account):
+		return self._egresses[egress_name(account.get('proxy'))]
+
+	def egress_stats(self):
+		return [egress.stats() for egress in self._egresses.values()]
+
+	def client(self, account, mode):
+		i = self._creds.index(account)
+		return self._app_clients[i] if mode == 'app' else self._user_clients[i]
+
+	def consume(self, section, account, calls=1):
+		if self._ledger is not None:
+			self._ledger.consume(cred_id(account), section, calls)
+		else:
+			with self._lock:
+				self._charge(section, account, calls)
+
+	def close(self):
+		if self._ledger is not None:
+			self._ledger.release()
+
+	def _get_leased(self, section, exhausted):
+		if exhausted is not None:
+			self._ledger.exhaust(cred_id(exhausted), section)
+
+		scores = {i: self._health[i].score() for i in self._cred_ids if self._health[i].allows()}
+		if not scores:
+			return self._least_quarantined()
+
+		account_id, remaining, reset = self._ledger.acquire(section, scores)
+		if remaining <= 0:
+			# The ledger may be stale, so probe the real limits once before making anyone wait
+			self._ledger.release(section)
+			self._app_limits, self._user_limits = self._build_limits()
+			self._build_queue(section, AccountManager.METHODS[section])
+			account_id, remaining, reset = self._ledger.acquire(section, scores)
+
+		account = self._creds[self._cred_ids.index(account_id)]
+		if remaining > 0:
+			return (account, 0)
+
+		time_to_wait = reset - int(datetime.datetime.timestamp(datetime.datetime.now()))
+		return (account, time_to_wait)
+
+	def _least_quarantined(self):
+		# Every account is quarantined: hand out the one that comes back first. An account
+		# with both auth modes revoked has nothing to come back with
+		candidates = [(self._health[i].cooldown(), n) for n, i in enumerate(self._cred_ids) if self._health[i].modes()]
+		if not candidates:
+			raise TweetlordError('All credentials revoked', errors={'code': 2, 'kind': 'revoked'})
+
+		cooldown, n = min(candidates)
+		return (self._creds[n], cooldown)
+
+	def _charge(self, section, account, calls):
+		# calls=None marks the account as exhausted
+		entries = self._queues[section].queue
+		for j, (limit, reset, i, cred) in enumerate(entries):
+			if cred is account:
+				entries[j] = (0 if calls is None else min(limit + calls, 0), reset, i, cred)
+				heapify(entries)
+				break
+
 	def _build_limits(self):
 		app_limits, user_limits = [], []
-		for app_client, user_client in zip(self._app_clients, self._user_clients):
+		for cred, app_client, user_client in zip(self._creds, self._app_clients, self._user_clients):
 			try:
-				tmp_app = app_client.rate_limit_status()
-				tmp_user = user_client.rate_limit_status()
+				with self.egress(cred).request():
+					tmp_app = app_client.rate_limit_status()
+				with self.egress(cred).request():
+					tmp_user = user_client.rate_limit_status()
 			except tweepy.error.RateLimitError:
 				pass
 			else:
@@ -776,22 +1855,1186 @@ class AccountManager:
 	def _build_queue(self, section, method):
 		queue = PriorityQueue(len(self._creds))
 		for i in range(len(self._creds)):
+			app_limit = self._app_limits[i]['resources'][section][method]
+			user_limit = self._user_limits[i]['resources'][section][method]
+
 			queue.put((
-				-(self._app_limits[i]['resources'][section][method]['remaining'] + self._user_limits[i]['resources'][section][method]['remaining']),
-				max(self._app_limits[i]['resources'][section][method]['reset'], self._user_limits[i]['resources'][section][method]['reset']),
+				-(app_limit['remaining'] + user_limit['remaining']),
+				max(app_limit['reset'], user_limit['reset']),
+				i,  # tie-breaker, credential dicts are not orderable
 				self._creds[i]
 			))
 
+			if self._ledger is not None:
+				self._ledger.record(
+					self._cred_ids[i],
+					section,
+					app_limit['limit'] + user_limit['limit'],
+					app_limit['remaining'] + user_limit['remaining'],
+					max(app_limit['reset'], user_limit['reset'])
+				)
+
 		return queue
 
 
+class Egress:
+
+	# One way out to the API (a proxy or the direct connection): caps the requests in flight
+	# through it and keeps its throughput stats for the run
+
+	def __init__(self, name, limit=EGRESS_LIMIT):
+		self.name = name
+		self._slots = threading.BoundedSemaphore(limit)
+		self._lock = threading.Lock()
+		self._requests = 0
+		self._failed = 0
+		self._busy = 0.0
+		self._first = self._last = None
+
+	@contextmanager
+	def request(self):
+		with self._slots:
+			started = time.time()
+			failed = True
+			try:
+				yield
+				failed = False
+			finally:
+				finished = time.time()
+				with self._lock:
+					self._requests += 1
+					self._failed += failed
+					self._busy += finished - started
+					self._first = started if self._first is None else min(self._first, started)
+					self._last = finished if self._last is None else max(self._last, finished)
+
+	def stats(self):
+		with self._lock:
+			elapsed = (self._last - self._first) if self._requests else 0
+			return {
+				'egress': self.name,
+				'requests': self._requests,
+				'failed': self._failed,
+				'rate': self._requests / elapsed if elapsed else 0,
+				'latency': self._busy / self._requests if self._requests else None
+			}
+
+
+class CredentialHealth:
+
+	# Rolling latency and error stats of one account. Accounts are ranked by their median
+	# latency inflated by the error rate; one that keeps failing is quarantined through its
+	# circuit breaker, and an auth mode that was revoked is left out for REVOKED_TTL seconds
+
+	SAMPLES = 50
+	MIN_SAMPLES = 20
+	MAX_ERROR_RATE = 0.5
+	ERROR_PENALTY = 4
+	REVOKED_TTL = 60 * 60
+
+	def __init__(self):
+		self.breaker = CircuitBreaker()
+		self.last_failure = None
+		self._latencies = deque(maxlen=CredentialHealth.SAMPLES)
+		self._errors = deque(maxlen=CredentialHealth.SAMPLES)
+		self._revoked = {}
+
+	def success(self, latency=None):
+		if latency is not None:
+			self._latencies.append(latency)
+		self._errors.append(False)
+		self.breaker.success()
+
+	def failure(self, kind, latency=None, mode=None):
+		if latency is not None:
+			self._latencies.append(latency)
+		self._errors.append(True)
+		self.last_failure = (time.time(), kind)
+
+		if kind == 'revoked':
+			self._revoked[mode] = time.time() + CredentialHealth.REVOKED_TTL
+		else:
+			self.breaker.failure()
+			if len(self._errors) >= CredentialHealth.MIN_SAMPLES and self.error_rate() > CredentialHealth.MAX_ERROR_RATE:
+				self.breaker.trip()
+
+	def allows(self):
+		return self.cooldown() <= 0
+
+	def cooldown(self):
+		cooldown = self.breaker.cooldown()
+		if not self.modes():
+			cooldown = max(cooldown, int(min(self._revoked.values()) - time.time()))
+		return cooldown
+
+	def modes(self):
+		now = time.time()
+		return [mode for mode in ApiRequest.MODES if self._revoked.get(mode, 0) <= now]
+
+	def percentile(self, q):
+		if not self._latencies:
+			return None
+		latencies = sorted(self._latencies)
+		return latencies[int(q * (len(latencies) - 1))]
+
+	def error_rate(self):
+		return sum(self._errors) / len(self._errors) if self._errors else 0
+
+	def score(self):
+		# Unknown accounts score 0, so every account gets probed before being ranked
+		return (self.percentile(0.5) or 0) * (1 + CredentialHealth.ERROR_PENALTY * self.error_rate())
+
+	def stats(self):
+		return {
+			'p50': self.percentile(0.5),
+			'p95': self.percentile(0.95),
+			'error_rate': self.error_rate(),
+			'last_failure': self.last_failure,
+			'modes': self.modes(),
+			'quarantine': self.cooldown()
+		}
+
+
+class CircuitBreaker:
+
+	# Opens after THRESHOLD transient failures in a row and keeps the account out of rotation
+	# for COOLDOWN seconds; after that a single trial request decides whether it closes again
+
+	THRESHOLD = 5
+	COOLDOWN = 5 * 60
+
+	def __init__(self):
+		self._failures = 0
+		self._opened_at = None
+
+	def success(self):
+		self._failures = 0
+		self._opened_at = None
+
+	def failure(self):
+		self._failures += 1
+		if self._failures >= CircuitBreaker.THRESHOLD:
+			self._opened_at = time.time()
+
+	def trip(self):
+		self._failures = CircuitBreaker.THRESHOLD
+		self._opened_at = time.time()
+
+	def allows(self):
+		return self.cooldown() <= 0
+
+	def cooldown(self):
+		if self._opened_at is None:
+			return 0
+		return max(int(self._opened_at + CircuitBreaker.COOLDOWN - time.time()), 0)
+
+
+# ----------------------------------------------------------
+# ---------------------- Lease Ledger ----------------------
+# ----------------------------------------------------------
+
+
+class LeaseLedger:
+
+	# Every process on the host leases one credential per section at a time and charges
+	# its requests against the shared budget table, so concurrent runs spread over the pool
+
+	LEASE_TTL = 120
+	WINDOW = 15 * 60
+
+	def __init__(self, path, owner=None, wal=True):
+		self._owner_prefix = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+		if wal:  # WAL needs shared memory, so it is off for stores on network shares
+			self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.executescript('''
+			CREATE TABLE IF NOT EXISTS budget (
+				cred TEXT NOT NULL,
+				section TEXT NOT NULL,
+				lim INTEGER NOT NULL,
+				remaining INTEGER NOT NULL,
+				reset INTEGER NOT NULL,
+				PRIMARY KEY (cred, section)
+			);
+			CREATE TABLE IF NOT EXISTS leases (
+				cred TEXT NOT NULL,
+				section TEXT NOT NULL,
+				owner TEXT NOT NULL,
+				expires INTEGER NOT NULL,
+				PRIMARY KEY (cred, section, owner)
+			);
+		''')
+
+	def record(self, cred, section, limit, remaining, reset):
+		with self._transaction():
+			self._conn.execute(
+				'INSERT OR REPLACE INTO budget (cred, section, lim, remaining, reset) VALUES (?, ?, ?, ?, ?)',
+				(cred, section, limit, remaining, reset)
+			)
+
+	def acquire(self, section, creds):
+		# creds maps every candidate to its health score (lower is better)
+		now = int(time.time())
+		with self._transaction():
+			self._expire_leases(now)
+			self._conn.execute('DELETE FROM leases WHERE section = ? AND owner = ?', (section, self._owner))
+
+			candidates = []
+			for cred in creds:
+				row = self._conn.execute(
+					'SELECT lim, remaining, reset FROM budget WHERE cred = ? AND section = ?', (cred, section)
+				).fetchone()
+				if row is None:
+					continue
+
+				limit, remaining, reset = row
+				if reset <= now:
+					remaining = limit
+
+				leases, = self._conn.execute(
+					'SELECT COUNT(*) FROM leases WHERE cred = ? AND section = ?', (cred, section)
+				).fetchone()
+
+				candidates.append((remaining <= 0, leases, creds[cred], -remaining, reset, cred))
+
+			if not candidates:
+				raise TweetlordError('No credentials known to the ledger', errors={'code': 3})
+
+			_, _, _, remaining, reset, cred = min(candidates)
+			self._conn.execute(
+				'INSERT INTO leases (cred, section, owner, expires) VALUES (?, ?, ?, ?)',
+				(cred, section, self._owner, now + LeaseLedger.LEASE_TTL)
+			)
+
+		return (cred, -remaining, reset)
+
+	def consume(self, cred, section, calls=1):
+		now = int(time.time())
+		with self._transaction():
+			self._conn.execute(
+				'''UPDATE budget SET
+					remaining = MAX(CASE WHEN reset <= ? THEN lim ELSE remaining END - ?, 0),
+					reset = CASE WHEN reset <= ? THEN ? ELSE reset END
+				WHERE cred = ? AND section = ?''',
+				(now, calls, now, now + LeaseLedger.WINDOW, cred, section)
+			)
+			self._conn.execute(
+				'UPDATE leases SET expires = ? WHERE cred = ? AND section = ? AND owner = ?',
+				(now + LeaseLedger.LEASE_TTL, cred, section, self._owner)
+			)
+
+	def exhaust(self, cred, section):
+		now = int(time.time())
+		with self._transaction():
+			self._conn.execute(
+				'UPDATE budget SET remaining = 0, reset = MAX(reset, ?) WHERE cred = ? AND section = ?',
+				(now + LeaseLedger.WINDOW, cred, section)
+			)
+			self._conn.execute(
+				'DELETE FROM leases WHERE cred = ? AND section = ? AND owner = ?', (cred, section, self._owner)
+			)
+
+	def release(self, section=None):
+		with self._transaction():
+			if section is None:
+				self._conn.execute('DELETE FROM leases WHERE owner LIKE ?', (self._owner_prefix + ':%',))
+			else:
+				self._conn.execute('DELETE FROM leases WHERE section = ? AND owner = ?', (section, self._owner))
+
+	def close(self):
+		self.release()
+		self._conn.close()
+
+	def _expire_leases(self, now):
+		self._conn.execute('DELETE FROM leases WHERE expires <= ?', (now,))
+
+		hostname = socket.gethostname()
+		for owner, in self._conn.execute('SELECT DISTINCT owner FROM leases').fetchall():
+			host, pid, _ = owner.split(':')
+			if host == hostname and not pid_alive(int(pid)):
+				self._conn.execute('DELETE FROM leases WHERE owner = ?', (owner,))
+
+	@property
+	def _owner(self):
+		# One lease holder per thread, so daemon workers dumping the same section don't share a lease
+		return '{}:{}'.format(self._owner_prefix, threading.get_ident())
+
+	@contextmanager
+	def _transaction(self):
+		with self._lock:
+			self._conn.execute('BEGIN IMMEDIATE')
+			try:
+				yield
+			except BaseException:
+				self._conn.execute('ROLLBACK')
+				raise
+			else:
+				self._conn.execute('COMMIT')
+
+
+# ----------------------------------------------------------
+# ------------------------ Crawler -------------------------
+# ----------------------------------------------------------
+
+
+class CrawlStore:
+
+	# Visited set, frontier and edges all live on disk, one transaction per expanded node,
+	# so a restarted crawl picks up at the first unexpanded node and memory stays flat
+
+	NODE_COLS = [
+		'User ID',
+		'User Login',
+		'User Name',
+		'Description',
+		'Friends Count',
+		'Followers Count',
+		'Statuses Count',
+		'Profile Image URL',
+		'Depth'
+	]
+
+	def __init__(self, path):
+		self._conn = sqlite3.connect(path)
+		self._conn.executescript('''
+			CREATE TABLE IF NOT EXISTS nodes (
+				id INTEGER PRIMARY KEY,
+				screen_name TEXT,
+				name TEXT,
+				description TEXT,
+				friends_count INTEGER,
+				followers_count INTEGER,
+				statuses_count INTEGER,
+				profile_image_url TEXT,
+				depth INTEGER NOT NULL,
+				expanded INTEGER NOT NULL DEFAULT 0
+			);
+			CREATE INDEX IF NOT EXISTS nodes_frontier ON nodes (expanded, depth);
+			CREATE TABLE IF NOT EXISTS edges (
+				src INTEGER NOT NULL,
+				dst INTEGER NOT NULL,
+				PRIMARY KEY (src, dst)
+			) WITHOUT ROWID;
+		''')
+
+		self._len = self._conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+	def __len__(self):
+		return self._len
+
+	def next_node(self, max_depth):
+		return self._conn.execute(
+			'SELECT id, depth, friends_count, followers_count FROM nodes '
+			'WHERE expanded = 0 AND depth < ? ORDER BY depth, rowid LIMIT 1', (max_depth,)
+		).fetchone()
+
+	def add_seed(self, user):
+		with self._conn:
+			self._len += self._insert_nodes([user], 0)
+
+	def add_page(self, node_id, depth, section, users, max_nodes):
+		# Saved page by page: a node whose expansion is cut short stays in the frontier with
+		# the edges found so far, and fetching its pages again on restart only adds what's missing.
+		# Returns True when max_nodes left a new account of the page out
+		truncated = False
+		with self._conn:
+			for user in users:
+				if self._len < max_nodes:
+					self._len += self._insert_nodes([user], depth + 1)
+				elif not self._conn.execute('SELECT 1 FROM nodes WHERE id = ?', (user.id,)).fetchone():
+					truncated = True
+					break
+
+			edges = [(node_id, user.id) if section == 'friends' else (user.id, node_id) for user in users]
+			self._conn.executemany(
+				'INSERT OR IGNORE INTO edges (src, dst) '
+				'SELECT ?, ? WHERE EXISTS (SELECT 1 FROM nodes WHERE id = ?)',
+				((src, dst, dst if src == node_id else src) for src, dst in edges)
+			)
+
+		return truncated
+
+	def mark_expanded(self, node_id):
+		with self._conn:
+			self._conn.execute('UPDATE nodes SET expanded = 1 WHERE id = ?', (node_id,))
+
+	def export(self, filename):
+		with open(filename + '.nodes.csv', 'w', newline='', encoding='utf-8') as f:
+			writer = csv.writer(f)
+			writer.writerow(CrawlStore.NODE_COLS)
+			writer.writerows(self._conn.execute(
+				'SELECT id, screen_name, name, description, friends_count, followers_count, '
+				'statuses_count, profile_image_url, depth FROM nodes ORDER BY depth, rowid'
+			))
+
+		with open(filename + '.edges.csv', 'w', newline='', encoding='utf-8') as f:
+			writer = csv.writer(f)
+			writer.writerow(['Source', 'Target'])
+			writer.writerows(self._conn.execute('SELECT src, dst FROM edges'))
+
+	def close(self):
+		self._conn.close()
+
+	def _insert_nodes(self, users, depth):
+		return self._conn.executemany(
+			'INSERT OR IGNORE INTO nodes (id, screen_name, name, description, friends_count, followers_count, '
+			'statuses_count, profile_image_url, depth) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+			((
+				user.id,
+				user.screen_name,
+				user.name,
+				unescape(user.description),
+				user.friends_count,
+				user.followers_count,
+				user.statuses_count,
+				user.profile_image_url_https.replace('_normal', '_400x400'),
+				depth
+			) for user in users)
+		).rowcount
+
+
+def crawl(dumper, seed, max_depth, max_nodes, friends, followers, filename, printer=None):
+	store = CrawlStore(filename + '.crawl.db')
+
+	try:
+		if not len(store):
+			print_info('Collecting seed account info')
+			store.add_seed(dumper.request(_api_user, 'user').call(seed))
+
+		while True:
+			node = store.next_node(max_depth)
+			if node is None or len(store) >= max_nodes:
+				break
+
+			node_id, depth, friends_count, followers_count = node
+			print_info('Expanding id{} (depth {}, {} nodes known)'.format(node_id, depth, len(store)))
+
+			stopped = truncated = False
+			for section, api_method, count, total in (('friends', _api_friends, friends, friends_count),
+			                                          ('followers', _api_followers, followers, followers_count)):
+				count = total if count == -1 else min(count, total)
+				if not count:
+					continue
+				try:
+					for users in dumper.pages(api_method, section, 'id{}'.format(node_id), count, total):
+						if store.add_page(node_id, depth, section, users, max_nodes):
+							# No room for the rest of its neighbours: leave it in the frontier
+							truncated = True
+							break
+				except TweetlordError as e:
+					print_warning('id{}: {}'.format(node_id, e), e.errors.get('initial', ''), write=tqdm.write)
+					# A protected or vanished account won't get any better, anything else will
+					if e.errors['code'] == 2 and e.errors.get('kind') != 'denied':
+						stopped = True
+						break
+				finally:
+					if printer:
+						printer.close()
+				if truncated:
+					break
+
+			if stopped:
+				print_warning('Crawl stopped at id{}, run again with the same -o to resume'.format(node_id))
+				break
+			if truncated:
+				print_info('Reached {} nodes at id{}, a bigger --max-nodes continues from there'.format(max_nodes, node_id))
+				break
+			store.mark_expanded(node_id)
+
+		print_info('Exporting {} nodes'.format(len(store)))
+		store.export(filename)
+	finally:
+		store.close()
+
+
+# ----------------------------------------------------------
+# ------------------------- Daemon -------------------------
+# ----------------------------------------------------------
+
+
+class FairQueue:
+
+	# Round-robin over submitting clients, so one client's batch of thousands of jobs
+	# doesn't starve everyone else
+
+	def __init__(self):
+		self._queues = {}
+		self._clients = deque()
+		self._cond = threading.Condition()
+
+	def put(self, client, item):
+		with self._cond:
+			if client not in self._queues:
+				self._queues[client] = deque()
+				self._clients.append(client)
+			self._queues[client].append(item)
+			self._cond.notify()
+
+	def get(self):
+		with self._cond:
+			while not self._clients:
+				self._cond.wait()
+
+			client = self._clients.popleft()
+			item = self._queues[client].popleft()
+			if self._queues[client]:
+				self._clients.append(client)
+			else:
+				del self._queues[client]
+
+			return item
+
+
+class JobServer:
+
+	SECTIONS = ('friends', 'followers', 'favorites', 'timeline')
+
+	def __init__(self, am, output_dir, workers, wait_on_rate_limit=False, db=None):
+		self._am = am
+		self._wait_on_rate_limit = wait_on_rate_limit
+		self._output_dir = output_dir
+		self._db = db
+		self._workers = workers
+		self._jobs = {}
+		self._queue = FairQueue()
+		self._lock = threading.Lock()
+		self._ids = itertools.count(1)
+
+	def submit(self, spec, client):
+		username = spec.get('user')
+		if not isinstance(username, str) or not username:
+			raise ValueError('"user" must be a non-empty string')
+
+		if spec.get('all') and any(spec.get(section) for section in JobServer.SECTIONS):
+			raise ValueError('Incompatible parameters: all,{}'.format(','.join(
+				section for section in JobServer.SECTIONS if spec.get(section)
+			)))
+
+		counts = {}
+		for section in JobServer.SECTIONS:
+			count = -1 if spec.get('all') else spec.get(section, 0)
+			if not isinstance(count, int) or count < -1:
+				raise ValueError('"{}" must be an integer >= -1'.format(section))
+			counts[section] = count
+
+		search = spec.get('search', 0)
+		if not isinstance(search, int) or search < -1:
+			raise ValueError('"search" must be an integer >= -1')
+		counts['search'] = search
+
+		query = spec.get('query')
+		if query is not None and not isinstance(query, str):
+			raise ValueError('"query" must be a string')
+
+		fmt = spec.get('format', 'xlsx')
+		if fmt not in ('xlsx', 'jsonl'):
+			raise ValueError('"format" must be "xlsx" or "jsonl"')
+
+		output = spec.get('output')
+		if output is not None and (not isinstance(output, str) or not format_filename(output)):
+			raise ValueError('"output" must be a file name')
+
+		with self._lock:
+			job_id = next(self._ids)
+			result = os.path.join(self._output_dir, '{}.{}'.format(format_filename(output or '{}_{}'.format(username, job_id)), fmt))
+			# Jobs that didn't fail own their result file, a second one would overwrite it
+			for other in self._jobs.values():
+				if other['result'] == result and other['status'] != 'failed':
+					raise ValueError('"output" is already used by job {}'.format(other['id']))
+
+			job = {
+				'id': job_id,
+				'client': spec.get('client', client),
+				'user': username,
+				'counts': counts,
+				'query': query,
+				'tweet_extended': bool(spec.get('tweet_extended')),
+				'summary': bool(spec.get('summary')),
+				'format': fmt,
+				'result': result,
+				'status': 'queued',
+				'error': None,
+				'submitted': time.time(),
+				'started': None,
+				'finished': None
+			}
+			self._jobs[job_id] = job
+
+		self._queue.put(job['client'], job)
+		return job
+
+	def jobs(self):
+		with self._lock:
+			return [dict(job) for job in self._jobs.values()]
+
+	def accounts(self):
+		return self._am.health()
+
+	def egress(self):
+		return self._am.egress_stats()
+
+	def job(self, job_id):
+		with self._lock:
+			job = self._jobs.get(job_id)
+			return dict(job) if job else None
+
+	def start(self):
+		os.makedirs(self._output_dir, exist_ok=True)
+		for _ in range(self._workers):
+			threading.Thread(target=self._work, daemon=True).start()
+
+	def _work(self):
+		while True:
+			job = self._queue.get()
+			job['status'], job['started'] = 'running', time.time()
+			try:
+				self._run(job)
+			except TweetlordError as e:
+				job['status'], job['error'] = 'failed', str(e)
+			except Exception as e:
+				print_warning('Job {} crashed'.format(job['id']), repr(e))
+				job['status'], job['error'] = 'failed', repr(e)
+			job['finished'] = time.time()
+
+	def _run(self, job):
+		filename = job['result'][:-len(job['format']) - 1]
+		sink = JsonlSink(filename) if job['format'] == 'jsonl' else None
+		db = SqliteSink(self._db, job['user'], job['query']) if self._db else None
+		dumper = Dumper(self._am, wait_on_rate_limit=self._wait_on_rate_limit, tweet_extended=job['tweet_extended'])
+
+		def on_row(section, table_row):
+			if sink:
+				sink.write(section, table_row)
+			if db:
+				db.write(section, table_row)
+
+		try:
+			dump = dump_profile(dumper, job['user'], query=job['query'], on_row=on_row, **job['counts'])
+		finally:
+			if sink:
+				sink.close()
+			if db:
+				db.close()
+
+		summary = build_summary(dump) if job['summary'] else None
+		if not sink:
+			build_xlsx(dump, filename, job['user'], summary)
+		elif summary:
+			write_summary(summary, filename)
+
+		job['status'] = 'done'
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		job_server = self.server.job_server
+		if self.path in ('/jobs', '/jobs/'):
+			return self._reply(200, job_server.jobs())
+
+		if self.path in ('/accounts', '/accounts/'):
+			return self._reply(200, job_server.accounts())
+
+		if self.path in ('/egress', '/egress/'):
+			return self._reply(200, job_server.egress())
+
+		if self.path.startswith('/jobs/'):
+			try:
+				job = job_server.job(int(self.path[len('/jobs/'):]))
+			except ValueError:
+				job = None
+			if job:
+				return self._reply(200, job)
+
+		self._reply(404, {'error': 'Not found'})
+
+	def do_POST(self):
+		if self.path not in ('/jobs', '/jobs/'):
+			return self._reply(404, {'error': 'Not found'})
+
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			spec = json.loads(self.rfile.read(length).decode('utf-8'))
+			if not isinstance(spec, dict):
+				raise ValueError('Job must be a JSON object')
+			job = self.server.job_server.submit(spec, self.client_address[0])
+		except ValueError as e:
+			return self._reply(400, {'error': str(e)})
+
+		self._reply(202, job)
+
+	def log_message(self, format, *args):
+		if DEBUG:
+			super().log_message(format, *args)
+
+	def _reply(self, code, body):
+		data = json.dumps(body).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+def serve(am, address, output_dir, workers, wait_on_rate_limit=False, db=None):
+	host, _, port = address.rpartition(':')
+	job_server = JobServer(am, output_dir, workers, wait_on_rate_limit, db)
+	job_server.start()
+
+	httpd = ThreadingHTTPServer((host or '127.0.0.1', int(port)), JobRequestHandler)
+	httpd.job_server = job_server
+
+	print_info('Serving jobs on http://{}:{}/jobs ({} workers)'.format(host or '127.0.0.1', port, workers))
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		cprint('Stopped', 'white', 'on_red', attrs=['bold'])
+	finally:
+		httpd.server_close()
+
+
+# ----------------------------------------------------------
+# ------------------------ Workers -------------------------
+# ----------------------------------------------------------
+
+
+class WorkStore:
+
+	# Jobs, page-level work units and collected rows shared by worker nodes. A unit is one
+	# API page; finishing it stores its rows and queues the next page in one transaction,
+	# so a page is either fully done or still up for grabs. Units whose worker stops
+	# sending heartbeats for UNIT_TTL seconds are handed to someone else, and so are jobs
+	# whose worker died while writing the output
+
+	UNIT_TTL = 90
+	MAX_ATTEMPTS = 3
+
+	def __init__(self, path):
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+		self._conn.executescript('''
+			CREATE TABLE IF NOT EXISTS jobs (
+				id INTEGER PRIMARY KEY,
+				spec TEXT NOT NULL,
+				status TEXT NOT NULL,
+				error TEXT,
+				submitted REAL NOT NULL,
+				finished REAL,
+				assembler TEXT,
+				heartbeat REAL
+			);
+			CREATE TABLE IF NOT EXISTS units (
+				id INTEGER PRIMARY KEY,
+				job_id INTEGER NOT NULL,
+				section TEXT NOT NULL,
+				arg TEXT NOT NULL,
+				seq INTEGER NOT NULL,
+				position INTEGER,
+				got INTEGER NOT NULL,
+				count INTEGER NOT NULL,
+				max_items INTEGER NOT NULL,
+				status TEXT NOT NULL,
+				worker TEXT,
+				heartbeat REAL,
+				attempts INTEGER NOT NULL DEFAULT 0
+			);
+			CREATE INDEX IF NOT EXISTS units_status ON units (status, id);
+			CREATE TABLE IF NOT EXISTS pages (
+				job_id INTEGER NOT NULL,
+				section TEXT NOT NULL,
+				seq INTEGER NOT NULL,
+				data TEXT NOT NULL
+			);
+			CREATE INDEX IF NOT EXISTS pages_job ON pages (job_id, section, seq);
+		''')
+
+	def submit(self, spec):
+		with self._transaction():
+			job_id = self._conn.execute(
+				'INSERT INTO jobs (spec, status, submitted) VALUES (?, ?, ?)', (json.dumps(spec), 'running', time.time())
+			).lastrowid
+			self._insert_unit(job_id, 'user', spec['user'], 0, None, 0, 1, 1)
+
+		return job_id
+
+	def claim(self, worker):
+		now = time.time()
+		with self._transaction():
+			row = self._conn.execute(
+				'SELECT id, job_id, section, arg, seq, position, got, count, max_items, attempts FROM units '
+				'WHERE status = \'pending\' OR (status = \'claimed\' AND heartbeat < ?) ORDER BY id LIMIT 1',
+				(now - WorkStore.UNIT_TTL,)
+			).fetchone()
+			if row is None:
+				return None
+
+			self._conn.execute(
+				'UPDATE units SET status = \'claimed\', worker = ?, heartbeat = ? WHERE id = ?', (worker, now, row[0])
+			)
+
+		unit = dict(zip(('id', 'job_id', 'section', 'arg', 'seq', 'position', 'got', 'count', 'max_items', 'attempts'), row))
+		unit['spec'] = self.spec(unit['job_id'])
+		return unit
+
+	def claim_assembly(self, worker):
+		# A job left in 'assembling' by a worker that stopped sending heartbeats
+		now = time.time()
+		with self._transaction():
+			row = self._conn.execute(
+				'SELECT id FROM jobs WHERE status = \'assembling\' AND heartbeat < ? ORDER BY id LIMIT 1',
+				(now - WorkStore.UNIT_TTL,)
+			).fetchone()
+			if row is None:
+				return None
+
+			self._conn.execute('UPDATE jobs SET assembler = ?, heartbeat = ? WHERE id = ?', (worker, now, row[0]))
+			return row[0]
+
+	def heartbeat(self, unit, worker):
+		with self._transaction():
+			self._conn.execute(
+				'UPDATE units SET heartbeat = ? WHERE id = ? AND worker = ? AND status = \'claimed\'',
+				(time.time(), unit['id'], worker)
+			)
+
+	def heartbeat_assembly(self, job_id, worker):
+		with self._transaction():
+			self._conn.execute(
+				'UPDATE jobs SET heartbeat = ? WHERE id = ? AND assembler = ? AND status = \'assembling\'',
+				(time.time(), job_id, worker)
+			)
+
+	def complete(self, unit, worker, table_rows, next_units):
+		# Returns True when this was the last unit of the job and the caller should assemble the output
+		with self._transaction():
+			updated = self._conn.execute(
+				'UPDATE units SET status = \'done\' WHERE id = ? AND worker = ? AND status = \'claimed\'',
+				(unit['id'], worker)
+			).rowcount
+			if not updated:  # Taken over by another worker in the meantime
+				return False
+
+			if table_rows:
+				self._conn.execute(
+					'INSERT INTO pages (job_id, section, seq, data) VALUES (?, ?, ?, ?)',
+					(unit['job_id'], unit['section'], unit['seq'], json.dumps(table_rows, ensure_ascii=False))
+				)
+			for next_unit in next_units:
+				self._insert_unit(unit['job_id'], *next_unit)
+
+			return self._close_job_if_finished(unit['job_id'], worker)
+
+	def release(self, unit, worker, failed=False):
+		with self._transaction():
+			attempts = unit['attempts'] + 1 if failed else unit['attempts']
+			status = 'failed' if attempts >= WorkStore.MAX_ATTEMPTS else 'pending'
+			updated = self._conn.execute(
+				'UPDATE units SET status = ?, worker = NULL, attempts = ? WHERE id = ? AND worker = ? AND status = \'claimed\'',
+				(status, attempts, unit['id'], worker)
+			).rowcount
+			return updated and status == 'failed' and self._close_job_if_finished(unit['job_id'], worker)
+
+	def fail_job(self, job_id, error):
+		with self._transaction():
+			self._conn.execute('UPDATE units SET status = \'failed\' WHERE job_id = ? AND status != \'done\'', (job_id,))
+			self._conn.execute(
+				'UPDATE jobs SET status = \'failed\', error = ?, finished = ? WHERE id = ?', (error, time.time(), job_id)
+			)
+
+	def finish_job(self, job_id):
+		# Pages that failed MAX_ATTEMPTS times leave their section cut short: say which ones
+		with self._transaction():
+			incomplete = [section for section, in self._conn.execute(
+				'SELECT DISTINCT section FROM units WHERE job_id = ? AND status = \'failed\' ORDER BY section', (job_id,)
+			)]
+			self._conn.execute(
+				'UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?', (
+					'incomplete' if incomplete else 'done',
+					'Incomplete sections: ' + ', '.join(incomplete) if incomplete else None,
+					time.time(),
+					job_id
+				)
+			)
+		return incomplete
+
+	def spec(self, job_id):
+		return json.loads(self._conn.execute('SELECT spec FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+
+	def jobs(self):
+		return self._conn.execute(
+			'SELECT jobs.id, jobs.status, jobs.error, COUNT(units.id), SUM(units.status = \'done\') '
+			'FROM jobs LEFT JOIN units ON units.job_id = jobs.id GROUP BY jobs.id ORDER BY jobs.id'
+		).fetchall()
+
+	def table_rows(self, job_id, section):
+		for data, in self._conn.execute(
+			'SELECT data FROM pages WHERE job_id = ? AND section = ? ORDER BY seq', (job_id, section)
+		):
+			yield from json.loads(data)
+
+	def close(self):
+		self._conn.close()
+
+	def _insert_unit(self, job_id, section, arg, seq, position, got, count, max_items):
+		self._conn.execute(
+			'INSERT INTO units (job_id, section, arg, seq, position, got, count, max_items, status) '
+			'VALUES (?, ?, ?, ?, ?, ?, ?, ?, \'pending\')',
+			(job_id, section, arg, seq, position, got, count, max_items)
+		)
+
+	def _close_job_if_finished(self, job_id, worker):
+		unfinished, = self._conn.execute(
+			'SELECT COUNT(*) FROM units WHERE job_id = ? AND status NOT IN (\'done\', \'failed\')', (job_id,)
+		).fetchone()
+		if unfinished:
+			return False
+
+		return bool(self._conn.execute(
+			'UPDATE jobs SET status = \'assembling\', assembler = ?, heartbeat = ? WHERE id = ? AND status = \'running\'',
+			(worker, time.time(), job_id)
+		).rowcount)
+
+	@contextmanager
+	def _transaction(self):
+		with self._lock:
+			self._conn.execute('BEGIN IMMEDIATE')
+			try:
+				yield
+			except BaseException:
+				self._conn.execute('ROLLBACK')
+				raise
+			else:
+				self._conn.execute('COMMIT')
+
+
+WORKER_SECTIONS = {
+	'friends': (_api_friends, lambda user, tweet_extended: _friend_row(user)),
+	'followers': (_api_followers, lambda user, tweet_extended: _follower_row(user)),
+	'favorites': (_api_favorites, _favorite_row),
+	'timeline': (_api_timeline, _timeline_row),
+	'search': (_api_search, _search_row)
+}
+
+def submit_job(store, username, counts, query=None, tweet_extended=False, fmt='xlsx', output='out', summary=False):
+	return store.submit({
+		'user': username,
+		'counts': counts,
+		'query': query,
+		'tweet_extended': tweet_extended,
+		'summary': summary,
+		'format': fmt,
+		'output': output_path(output)
+	})
+
+
+def work(am, store, poll=5, stop=None):
+	worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+	requests_by_section = {}
+	rate_limited = {'time_to_wait': 0}
+	current = {'unit': None, 'job': None}
+
+	def on_rate_limit(section, time_to_wait, error):
+		rate_limited['time_to_wait'] = time_to_wait
+
+	def on_retry(section, delay, error):
+		print_warning('{}: Transient error, retrying in {:.1f} seconds'.format(section, delay), str(error))
+
+	stop = stop or threading.Event()
+
+	def heartbeat():
+		while not stop.wait(WorkStore.UNIT_TTL / 3):
+			unit, job_id = current['unit'], current['job']
+			if unit is not None:
+				store.heartbeat(unit, worker)
+			if job_id is not None:
+				store.heartbeat_assembly(job_id, worker)
+
+	def assemble(job_id):
+		# A job whose output can't be written fails instead of killing the worker
+		current['job'] = job_id
+		try:
+			assemble_job(store, job_id)
+		except Exception as e:
+			print_warning('Job {} failed: could not write the output'.format(job_id), str(e))
+			store.fail_job(job_id, 'Could not write the output: {}'.format(e))
+		finally:
+			current['job'] = None
+
+	dumper = Dumper(am, on_rate_limit=on_rate_limit, on_retry=on_retry)
+	threading.Thread(target=heartbeat, daemon=True).start()
+	print_info('Worker {} is waiting for jobs'.format(worker))
+
+	while not stop.is_set():
+		job_id = store.claim_assembly(worker)
+		if job_id is not None:
+			assemble(job_id)
+			continue
+
+		unit = store.claim(worker)
+		if unit is None:
+			stop.wait(poll)
+			continue
+
+		spec = unit['spec']
+		if unit['section'] not in requests_by_section:
+			api_method = _api_user if unit['section'] == 'user' else WORKER_SECTIONS[unit['section']][0]
+			requests_by_section[unit['section']] = dumper.request(api_method, unit['section'])
+		request = requests_by_section[unit['section']]
+
+		current['unit'] = unit
+		rate_limited['time_to_wait'] = 0
+		try:
+			table_rows, next_units = _work_unit(request, unit, spec)
+		except TweetlordError as e:
+			current['unit'] = None
+			if e.errors['code'] in (1, -1):
+				print_warning('Job {}: {}'.format(unit['job_id'], e), e.errors.get('initial', ''))
+				store.fail_job(unit['job_id'], str(e))
+				continue
+
+			if rate_limited['time_to_wait'] > 0:
+				# Every local account is empty: leave the page to nodes that still have budget
+				store.release(unit, worker)
+				print_warning('Rate limit exceeded, all accounts are empty. Waiting {} minutes {} seconds'.format(
+					rate_limited['time_to_wait'] // 60, rate_limited['time_to_wait'] % 60
+				), e.errors.get('initial', ''))
+				stop.wait(rate_limited['time_to_wait'])
+			elif e.errors.get('kind') in ('quarantined', 'revoked'):
+				# A problem with the local accounts, not with the page: don't burn its attempts
+				store.release(unit, worker)
+				print_warning('Job {}: {}, releasing the page'.format(unit['job_id'], e), e.errors.get('initial', ''))
+				stop.wait(poll)
+			elif store.release(unit, worker, failed=True):
+				assemble(unit['job_id'])
+			continue
+
+		current['unit'] = None
+		if store.complete(unit, worker, table_rows, next_units):
+			assemble(unit['job_id'])
+
+
+def _work_unit(request, unit, spec):
+	tweet_mode = 'extended' if spec['tweet_extended'] else None
+
+	if unit['section'] == 'user':
+		user_row, max_items = user_info(request, unit['arg'])
+		print_info('Job {}: collected basic account info of {}'.format(unit['job_id'], unit['arg']))
+
+		next_units = []
+		for section, count in spec['counts'].items():
+			if not count:
+				continue
+
+			if section == 'search':
+				arg = spec['query'] or '@' + user_row.user_login
+				count = count if count != -1 else sys.maxsize
+				section_max = count
+			else:
+				arg = unit['arg']
+				section_max = max_items[section]
+				if count == -1:
+					count = section_max if section != 'timeline' else min(section_max, 3200)
+
+			position = -1 if section in ('friends', 'followers') else None
+			next_units.append((section, arg, 0, position, 0, count, section_max))
+
+		return ([list(user_row)], next_units)
+
+	api_method, build_row = WORKER_SECTIONS[unit['section']]
+	page, next_position = request.call(
+		unit['arg'],
+		position=unit['position'],
+		count=100 if api_method is _api_search else 200,
+		tweet_extended=tweet_mode
+	)
+
+	page = page[:unit['count'] - unit['got']]
+	got = unit['got'] + len(page)
+	print_info('Job {}: {} page {} ({} items)'.format(unit['job_id'], unit['section'], unit['seq'] + 1, got))
+
+	next_units = []
+	if next_position is not None and got < unit['count'] and got < unit['max_items'] and page:
+		next_units.append((unit['section'], unit['arg'], unit['seq'] + 1, next_position, got, unit['count'], unit['max_items']))
+
+	return ([list(build_row(item, tweet_mode)) for item in page], next_units)
+
+
+def assemble_job(store, job_id):
+	spec = store.spec(job_id)
+	dump = dict.fromkeys(ROW_TYPES)
+	for section, row_type in ROW_TYPES.items():
+		if section == 'user':
+			table_rows = [row_type(*table_row) for table_row in store.table_rows(job_id, section)]
+			dump[section] = table_rows[0] if table_rows else None
+		else:
+			table_rows = RowTable(row_type)
+			table_rows.extend(row_type._make(table_row) for table_row in store.table_rows(job_id, section))
+			dump[section] = table_rows or None
+
+	if dump['user'] is None:
+		store.fail_job(job_id, 'Basic account info could not be collected')
+		print_warning('Job {} failed: basic account info could not be collected'.format(job_id))
+		return
+
+	summary = build_summary(dump) if spec.get('summary') else None
+	if spec['format'] == 'jsonl':
+		sink = JsonlSink(spec['output'])
+		try:
+			sink.write('user', dump['user'])
+			for section in ('friends', 'followers', 'favorites', 'timeline', 'search'):
+				for table_row in dump[section] or ():
+					sink.write(section, table_row)
+		finally:
+			sink.close()
+		if summary:
+			write_summary(summary, spec['output'])
+	else:
+		build_xlsx(dump, spec['output'], spec['user'], summary)
+
+	incomplete = store.finish_job(job_id)
+	if incomplete:
+		print_warning('Job {} done with incomplete sections ({}): {}.{}'.format(job_id, ', '.join(incomplete), spec['output'], spec['format']))
+	else:
+		print_info('Job {} done: {}.{}'.format(job_id, spec['output'], spec['format']))
+
+
 # ----------------------------------------------------------
 # ------------------------- Utils --------------------------
 # ----------------------------------------------------------
 
 
-def flatten(pages):
-	return (status for page in pages for status in page)
+def _ignore(*args, **kwargs):
+	pass
+
+
+def cred_id(cred):
+	key = '{}:{}'.format(cred['consumer_key'], cred['access_token_key'])
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def egress_name(proxy):
+	# Proxy credentials are left out of the name, it ends up in stats and logs
+	if not proxy:
+		return 'direct'
+	url = urlsplit(proxy)
+	return '{}://{}'.format(url.scheme, url.hostname + (':{}'.format(url.port) if url.port else ''))
+
+
+def pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+
+def output_path(output):
+	# Only the file name is cleaned up, the directory is kept (resolved on this host)
+	directory, filename = os.path.split(output)
+	return os.path.join(os.path.abspath(directory), format_filename(filename))
 
 
 def format_filename(s):
@@ -836,6 +3079,65 @@ def print_critical(message, initial_error=''):
 	cprint('[CRITICAL] {}'. format(message), 'white', 'on_red', attrs=['bold'])
 
 
+def print_health(am):
+	for stats in am.health():
+		p50 = '{:.2f}s'.format(stats['p50']) if stats['p50'] is not None else '-'
+		p95 = '{:.2f}s'.format(stats['p95']) if stats['p95'] is not None else '-'
+		print('[*] Account {}: p50 {}, p95 {}, errors {:.0%}, modes {}{}'.format(
+			stats['account'], p50, p95, stats['error_rate'], ','.join(stats['modes']) or '-',
+			', quarantined for {}s'.format(stats['quarantine']) if stats['quarantine'] else ''
+		), file=sys.stderr)
+
+
+def print_egress(am):
+	for stats in am.egress_stats():
+		print('[*] Egress {}: {} requests ({:.1f} req/s, avg {}), {} failed'.format(
+			stats['egress'], stats['requests'], stats['rate'],
+			'{:.2f}s'.format(stats['latency']) if stats['latency'] is not None else '-', stats['failed']
+		))
+
+
+class ProgressPrinter:
+
+	UNITS = {
+		'friends': 'fr',
+		'followers': 'fol',
+		'favorites': 'fav',
+		'timeline': 'tw',
+		'search': 'tw'
+	}
+
+	def __init__(self, wait_on_rate_limit=False):
+		self._wait_on_rate_limit = wait_on_rate_limit
+		self._section = None
+		self._pbar = None
+
+	def progress(self, section, got, total):
+		if section != self._section:
+			self.close()
+			self._section = section
+			self._pbar = tqdm(total=total, ncols=80, unit=ProgressPrinter.UNITS.get(section, ''), desc='    got')
+		self._pbar.update(got - self._pbar.n)
+
+	def rate_limit(self, section, time_to_wait, error):
+		if time_to_wait <= 0:
+			tqdm.write('[*] Account switched')
+		elif self._wait_on_rate_limit:
+			tqdm.write('[*] It\'s {} on the clock'.format(time.strftime('%H:%M:%S', time.localtime())))
+			print_warning(
+				'{}: Rate limit exceeded, all accounts are empty. Waiting {} minutes {} seconds'
+				.format(section, time_to_wait // 60, time_to_wait % 60), str(error), write=tqdm.write
+			)
+
+	def retry(self, section, delay, error):
+		print_warning('{}: Transient error, retrying in {:.1f} seconds'.format(section, delay), str(error), write=tqdm.write)
+
+	def close(self):
+		if self._pbar is not None:
+			self._pbar.close()
+		self._section = self._pbar = None
+
+
 # ----------------------------------------------------------
 # -------------------------- Opts --------------------------
 # ----------------------------------------------------------
@@ -846,15 +3148,31 @@ def cli_options():
 	group = parser.add_mutually_exclusive_group(required=True)
 	group.add_argument('-u', '--user')
 	group.add_argument('-l', '--show-limits', action='store_true')
+	group.add_argument('-s', '--serve', type=str, metavar='[HOST:]PORT')
+	group.add_argument('-c', '--crawl', type=str, metavar='SEED')
+	group.add_argument('-W', '--worker', action='store_true')
+	group.add_argument('--jobs', action='store_true')
 	parser.add_argument('-fr', '--friends', type=int, default=0)
 	parser.add_argument('-fo', '--followers', type=int, default=0)
 	parser.add_argument('-fa', '--favorites', type=int, default=0)
 	parser.add_argument('-ti', '--timeline', type=int, default=0)
+	parser.add_argument('-se', '--search', type=int, default=0)
+	parser.add_argument('-q', '--query', type=str, default=None)
 	parser.add_argument('-a', '--all', action='store_true')
 	parser.add_argument('-o', '--output', type=str, default='out')
-	parser.add_argument('-w', '--wait-on-limit', action='store_const', const='extended')
-	parser.add_argument('-e', '--tweet-extended', action='store_const', const='extended')
+	parser.add_argument('-f', '--format', choices=('xlsx', 'jsonl'), default='xlsx')
+	parser.add_argument('-w', '--wait-on-limit', action='store_true')
+	parser.add_argument('-e', '--tweet-extended', action='store_true')
+	parser.add_argument('--summary', action='store_true')
 	parser.add_argument('-d', '--debug', action='store_true')
+	parser.add_argument('--ledger', type=str, default=None)
+	parser.add_argument('--store', type=str, default=None)
+	parser.add_argument('--db', type=str, metavar='PATH', default=None)
+	parser.add_argument('--images', type=str, metavar='DIR', default=None)
+	parser.add_argument('--workers', type=int, default=2)
+	parser.add_argument('--egress-limit', type=int, metavar='N', default=EGRESS_LIMIT)
+	parser.add_argument('--depth', type=int, default=2)
+	parser.add_argument('--max-nodes', type=int, default=10000)
 	return parser.parse_args()
 
 
@@ -867,19 +3185,23 @@ def main():
 	print(BANNER + '\n')
 
 	args = cli_options()
-	global WAIT_ON_RATE_LIMIT; WAIT_ON_RATE_LIMIT = args.wait_on_limit
 	global DEBUG; DEBUG = args.debug
 
+	from credentials import credentials
+
 	if args.show_limits:
 		for cred in credentials:
 			for key, val in cred.items():
 				print('{}: \"{}\"'.format(key, val))
 			print()
 			try:
+				check_proxy(cred)
 				show_limits(tweepy_auth(cred, mode='app')); print()
 				show_limits(tweepy_auth(cred, mode='user')); print()
 			except tweepy.error.RateLimitError as e:
 				print_critical('No rate limit to run \"rate_limit_status()\". Wait 15 minutes and try again', str(e))
+			except TweetlordError as e:
+				print_critical(str(e), e.errors.get('initial', ''))
 		return
 
 	if args.all and (args.friends or args.followers or args.favorites or args.timeline):
@@ -892,57 +3214,166 @@ def main():
 		print('Incompatible parameters: all,{}'.format(','.join(key for key, val in incompatible.items() if val)))
 		return
 
+	if (args.worker or args.jobs) and not args.store:
+		print('Worker mode needs the shared store: --store PATH')
+		return
+
+	if args.all:
+		args.friends = args.followers = args.favorites = args.timeline = -1
+
+	if args.store and (args.user or args.jobs):
+		store = WorkStore(args.store)
+		if args.user:
+			counts = {
+				'friends': args.friends,
+				'followers': args.followers,
+				'favorites': args.favorites,
+				'timeline': args.timeline,
+				'search': args.search
+			}
+			job_id = submit_job(store, args.user, counts, args.query, args.tweet_extended, args.format, args.output, args.summary)
+			print_info('Job {} submitted to {}'.format(job_id, args.store))
+		else:
+			for job_id, status, error, units, done in store.jobs():
+				print('[{}] {:<10} {}/{} pages{}'.format(job_id, status, done or 0, units, ' -- ' + error if error else ''))
+		store.close()
+		return
+
 	timestart = time.time()
 	print('[*] Started at {}\n'.format(time.strftime('%H:%M:%S', time.localtime())))
 
-	dump = dict.fromkeys(('user', 'friends', 'followers', 'favorites', 'timeline'))
-
 	print_info('Initializing account manager')
-	am = AccountManager(credentials)
+	if args.ledger:
+		ledger = LeaseLedger(args.ledger)
+	elif args.worker:
+		# Record the budget of this node's accounts centrally, next to the jobs
+		ledger = LeaseLedger(args.store, wal=False)
+	else:
+		ledger = None
+	try:
+		am = AccountManager(credentials, ledger=ledger, egress_limit=args.egress_limit)
+	except TweetlordError as e:
+		print_critical(str(e), e.errors.get('initial', ''))
+		if ledger is not None:
+			ledger.close()
+		return
+
+	if args.worker:
+		store = WorkStore(args.store)
+		try:
+			work(am, store)
+		except KeyboardInterrupt:
+			cprint('Stopped', 'white', 'on_red', attrs=['bold'])
+		finally:
+			print_egress(am)
+			store.close()
+			am.close()
+			if ledger is not None:
+				ledger.close()
+		return
+
+	if args.serve:
+		try:
+			serve(am, args.serve, args.output, args.workers, args.wait_on_limit, args.db)
+		finally:
+			am.close()
+			if ledger is not None:
+				ledger.close()
+		return
+
+	printer = ProgressPrinter(args.wait_on_limit)
+	dumper = Dumper(
+		am,
+		wait_on_rate_limit=args.wait_on_limit,
+		tweet_extended=args.tweet_extended,
+		on_progress=printer.progress,
+		on_rate_limit=printer.rate_limit,
+		on_retry=printer.retry
+	)
+
+	if args.crawl:
+		if not (args.friends or args.followers):
+			print('Nothing to crawl: set the number of friends (-fr) and/or followers (-fo) to expand per account')
+		else:
+			try:
+				crawl(dumper, args.crawl, args.depth, args.max_nodes, args.friends, args.followers, format_filename(args.output), printer)
+			except TweetlordError as e:
+				print_critical(str(e), e.errors.get('initial', ''))
+			else:
+				print(); print_info('Success! Result: {0}.nodes.csv, {0}.edges.csv'.format(format_filename(args.output)))
+			finally:
+				am.close()
+				if ledger is not None:
+					ledger.close()
+
+		print(); print_egress(am)
+		print('[*] Time taken: {}'.format(datetime.timedelta(seconds=time.time() - timestart)))
+		print('[*] Shut down at {}'.format(time.strftime('%H:%M:%S', time.localtime())))
+		return
+
+	filename = format_filename(args.output)
+	sink = JsonlSink(filename) if args.format == 'jsonl' else None
+	db = SqliteSink(args.db, args.user, args.query) if args.db else None
+	downloader = ImageDownloader(args.images, filename) if args.images else None
+
+	def on_row(section, table_row):
+		if sink:
+			sink.write(section, table_row)
+		if db:
+			db.write(section, table_row)
+		if downloader:
+			downloader.submit(section, table_row)
 
 	try:
-		print_info('Collecting basic account info')
-		dump['user'], max_items = user_info(am, args.user)
-
-		if args.friends or args.all:
-			if args.friends == -1 or args.all:
-				args.friends = max_items['friends']
-			print_info('Collecting user friends info')
-			dump['friends'] = user_friends(am, args.user, args.friends, max_items['friends'])
-
-		if args.followers or args.all:
-			if args.followers == -1 or args.all:
-				args.followers = max_items['followers']
-			print_info('Collecting user followers info')
-			dump['followers'] = user_followers(am, args.user, args.followers, max_items['followers'])
-
-		if args.favorites or args.all:
-			if args.favorites == -1 or args.all:
-				args.favorites = max_items['favorites']
-			print_info('Collecting user favorites info')
-			dump['favorites'] = user_favorites(am, args.user, args.favorites, max_items['favorites'], args.tweet_extended)
-
-		if args.timeline or args.all:
-			if args.timeline == -1 or args.all:
-				# From developer.twitter.com: "This method can only return up to 3,200 of a user's most recent Tweets".
-				args.timeline = max_items['timeline'] if max_items['timeline'] < 3200 else 3200
-			print_info('Collecting user timeline info')
-			dump['timeline'] = user_timeline(am, args.user, args.timeline, max_items['timeline'], args.tweet_extended)
+		dump = dump_profile(
+			dumper,
+			args.user,
+			args.friends,
+			args.followers,
+			args.favorites,
+			args.timeline,
+			args.search,
+			args.query,
+			on_row=on_row,
+			printer=printer
+		)
 
 	except TweetlordError as e:
-		if e.errors['code'] == 1:
-			print_critical(str(e), e.errors['initial'])
+		print_critical(str(e), e.errors.get('initial', ''))
 
 	else:
 		if any(section for section in dump.values()):
-			print_info('Building .xlsx file')
-			filename = format_filename(args.output)
-			build_xlsx(dump, filename, args.user)
-			print(); print_info('Success! Result: {}.xlsx'.format(filename))
+			summary = build_summary(dump) if args.summary else None
+			if sink:
+				if summary:
+					write_summary(summary, filename)
+				print(); print_info('Success! Result: {}.jsonl{}'.format(filename, ', {}.summary.json'.format(filename) if summary else ''))
+			else:
+				print_info('Building .xlsx file')
+				build_xlsx(dump, filename, args.user, summary)
+				print(); print_info('Success! Result: {}.xlsx'.format(filename))
 		else:
 			print_critical('No data collected')
 
-	print('\n[*] Time taken: {}'.format(datetime.timedelta(seconds=time.time() - timestart)))
+	finally:
+		printer.close()
+		if sink:
+			sink.close()
+		if db:
+			db.close()
+			print_info('Rows stored in {} (run {})'.format(args.db, db.run_id))
+		if downloader:
+			print_info('Waiting for profile images')
+			stats = downloader.close()
+			print_info('Profile images: {downloaded} downloaded, {duplicate} already stored, {failed} failed. Index: {0}.images.csv'.format(filename, **stats))
+		if DEBUG:
+			print_health(am)
+		am.close()
+		if ledger is not None:
+			ledger.close()
+
+	print(); print_egress(am)
+	print('[*] Time taken: {}'.format(datetime.timedelta(seconds=time.time() - timestart)))
 	print('[*] Shut down at {}'.format(time.strftime('%H:%M:%S', time.localtime())))
 
 